@@ -4,140 +4,1050 @@ import ahocorasick
 import cython
 from Bio import SeqIO
 import os
+import hashlib
+import heapq
+import itertools
+import tempfile
+import pickle
+import multiprocessing
+import gzip
+import io
+import mmap
+import queue
+import shutil
+import subprocess
+import threading
+from collections import Counter
+from operator import itemgetter
+from time import perf_counter
+
+# directory holding the prebuilt database index for each (database, k) pair
+INDEX_DIR = '.ffindex'
+# bumped whenever the layout of the pickled Database changes so old indexes are rebuilt
+INDEX_VERSION = 7
+# default element type of the coverage array, one count per database position
+COVERAGE_DTYPE = np.uint32
+# number of buffered hit offsets before they are scatter-added into the coverage array
+HIT_BUFFER_SIZE = 1 << 20
+# bytes read from an NGS file at a time by the packed engine
+BLOCK_SIZE = 1 << 23
+# bytes of a memory mapped NGS file scanned before its pages are released
+MMAP_WINDOW = 1 << 26
+# distinct reads held by the duplicate collapsing table before it is spilled to disk as a sorted run
+COLLAPSE_TABLE_SIZE = 1 << 22
+# distinct reads handed to the engines at a time once collapsed
+COLLAPSE_BLOCK = 1 << 16
+# matching engines: Aho-Corasick over str lines, or 2-bit packed k-mers looked up in a sorted table
+ENGINES = ('automaton', 'packed')
+# threads used by an external bgzip/pigz to decompress gzip input
+DECOMPRESS_THREADS = min(os.cpu_count() or 1, 8)
+
+# leading bits of a packed k-mer used to index the bucket table of the packed engine
+PACK_BUCKET_BITS = 20
+
+# 2-bit code of each nucleotide byte, anything else (N, IUPAC codes, newlines) is 4
+PACK_LUT = np.full(256, 4, dtype=np.uint8)
+PACK_LUT[ord('A')] = 0
+PACK_LUT[ord('C')] = 1
+PACK_LUT[ord('G')] = 2
+PACK_LUT[ord('T')] = 3
 
 # Generate the 18-mer array
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef get_kmers_arr(str individual_seq, int k):
-    cdef int i
+#   a zero-copy view over the sequence bytes: element i is the k bytes starting at position i
+cpdef get_kmers_arr(bytes individual_seq, int k):
     cdef Py_ssize_t num_kmers = len(individual_seq) - k + 1
-    kmers = np.zeros(num_kmers, dtype=np.dtype('U' + str(k)))
-    for i in range(num_kmers):
-        kmers[i] = individual_seq[i:i+k]
-    return kmers
+    if num_kmers <= 0:
+        return np.empty(0, dtype=np.dtype('S' + str(k)))
+    return np.ndarray(shape=(num_kmers,), dtype=np.dtype('S' + str(k)), buffer=individual_seq, strides=(1,))
+
+# Database file parsed once per session: sequences, offsets and the automata
+#   offsets maps every UID to the (offset, length) of its slice of the contiguous coverage array
+#   the automaton maps every 18-mer to the posting list of all coverage offsets it occurs at
+#   packed holds the same postings keyed by 2-bit packed 18-mer for the packed engine
+class Database:
+    def __init__(self, path, k, db_hash, seqs, offsets, total_length, automaton, packed):
+        self.path = path
+        self.k = k
+        self.hash = db_hash
+        self.seqs = seqs
+        self.offsets = offsets
+        self.total_length = total_length
+        self.automaton = automaton
+        self.packed = packed
 
 # Create index to store 18-mer arrays mapped to each UID
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef create_uid_index(str db_file, int k):
+cpdef dict create_uid_index(dict seqs, int k):
     cdef dict uid_index = {}
-    cdef str s
-    with open(db_file, 'r') as f:
-        for record in SeqIO.parse(f, "fasta"):
-            s = str(record.seq)
-            if len(s) > 0:
-                uid_index[record.id] = get_kmers_arr(s, k)
-            else:
-                continue
+    cdef str key, s
+    for key, s in seqs.items():
+        uid_index[key] = get_kmers_arr(s.encode('ascii'), k)
     return uid_index
 
+# Build the automaton mapping every distinct 18-mer to the coverage offsets it occurs at
+#   k-mers are grouped with one stable sort, so a str is only created once per distinct k-mer
+cpdef build_automaton(dict uid_index, dict offsets, int k):
+    cdef list views = []
+    cdef list positions = []
+    cdef str key
+    cdef long off
+    for key, ss_arr in uid_index.items():
+        off = offsets[key][0]
+        views.append(ss_arr)
+        positions.append(np.arange(off, off + len(ss_arr), dtype=np.int64))
 
-# Get length of the original miRNAs
-cpdef uid_length_index(str db_file):
+    ac = ahocorasick.Automaton()
+    if not views:
+        return ac
+    mers = np.concatenate(views)
+    offs = np.concatenate(positions)
+    order = np.argsort(mers, kind='stable')
+    mers = mers[order]
+    offs = offs[order]
+
+    # start of each run of identical k-mers in the sorted array
+    starts = np.flatnonzero(np.concatenate(([True], mers[1:] != mers[:-1])))
+    ends = np.append(starts[1:], len(mers))
+    for a, b in zip(starts.tolist(), ends.tolist()):
+        ac.add_word(mers[a].decode('ascii'), tuple(offs[a:b].tolist()))
+    ac.make_automaton()
+    return ac
+
+
+# Build the packed k-mer table: sorted distinct codes and a CSR posting list of coverage offsets
+#   codes[i] occurs at post[starts[i]:starts[i+1]], k-mers containing non-ACGT bases are left out
+#   buckets[b]:buckets[b+1] is the range of codes whose leading bits equal b, so most lookups never search
+cpdef tuple build_packed_index(dict seqs, dict offsets, long total_length, int k):
+    if k > 32:
+        raise ValueError(f'The packed engine supports k-mers of at most 32 bases (k={k})')
+    cdef long num_windows = total_length - k + 1
+    cdef int bucket_bits = min(PACK_BUCKET_BITS, 2 * k)
+    if num_windows <= 0:
+        return (np.empty(0, dtype=np.uint64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.zeros((1 << bucket_bits) + 1, dtype=np.int64))
+
+    # every record is placed at its own offset of the coverage array, positions a record does not
+    #   cover (a record overridden by a later one with the same UID) are left as N and never match
+    joined = np.full(total_length, ord('N'), dtype=np.uint8)
+    record_end = np.zeros(total_length, dtype=np.int64)
+    cdef str key, s
+    cdef long off
+    for key, s in seqs.items():
+        off = offsets[key][0]
+        joined[off:off+len(s)] = np.frombuffer(s.encode('ascii'), dtype=np.uint8)
+        record_end[off:off+len(s)] = off + len(s)
+
+    vals = PACK_LUT[joined]
+    invalid = np.concatenate(([0], np.cumsum(vals > 3)))
+    positions = np.arange(num_windows, dtype=np.int64)
+    valid = (invalid[k:] - invalid[:num_windows] == 0) & (positions + k <= record_end[:num_windows])
+
+    codes = np.zeros(num_windows, dtype=np.uint64)
+    wide = vals.astype(np.uint64)
+    for j in range(k):
+        codes = (codes << np.uint64(2)) | wide[j:j+num_windows]
+    codes = codes[valid]
+    positions = positions[valid]
+
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    positions = positions[order]
+    first = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    starts = np.append(first, len(codes)).astype(np.int64)
+    codes = codes[first]
+    leading = codes >> np.uint64(2 * k - bucket_bits)
+    buckets = np.searchsorted(leading, np.arange((1 << bucket_bits) + 1, dtype=np.uint64)).astype(np.int64)
+    return (codes, starts, positions, buckets)
+
+# Allocate one contiguous coverage array covering every record in the database
+cpdef new_coverage(db, dtype=None):
+    return np.zeros(db.total_length, dtype=COVERAGE_DTYPE if dtype is None else dtype)
+
+# Map each UID to its zero-copy view of the coverage array
+cpdef dict coverage_views(db, coverage):
     cdef dict matches = {}
-    cdef str s
+    cdef str key
+    cdef long off
     cdef int x
-    with open(db_file, 'r') as f:
-        for record in SeqIO.parse(f, "fasta"):
-            s = str(record.seq)
-            x = len(s)
-            temp_vector = np.zeros(x)
-            matches[record.id] = temp_vector
+    for key, (off, x) in db.offsets.items():
+        matches[key] = coverage[off:off+x]
     return matches
 
+# Get length of the original miRNAs
+cpdef uid_length_index(db, dtype=None):
+    return coverage_views(db, new_coverage(db, dtype))
+
 # Create dictionary of UIDs and original strings for those RNAs
-cpdef original_strings(db_file):
-    cdef dict records = {}
+cpdef original_strings(db):
+    return db.seqs
+
+# extension of the NGS format, ignoring a trailing .gz (reads.fastq.gz -> .fastq)
+cpdef get_file_extension(file_path):
+    root, ext = os.path.splitext(file_path)
+    if ext.lower() == '.gz':
+        ext = os.path.splitext(root)[1]
+    return ext
+
+# check if an NGS file is gzip (or BGZF) compressed
+cpdef bint is_compressed(str file_path):
+    return file_path.lower().endswith('.gz')
+
+# check if a gzip file is BGZF: its first member carries the 'BC' extra subfield
+cpdef bint is_bgzf(str file_path):
+    with open(file_path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+'''
+    gzip input decompressed concurrently with the alignment
+        - a background thread fills a bounded queue with decompressed blocks; zlib releases
+          the GIL so decompression overlaps with the automaton or packed scan
+'''
+class ThreadedGzipReader(io.RawIOBase):
+    def __init__(self, path, block_size=BLOCK_SIZE, depth=4):
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._block = b''
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, args=(path, block_size), daemon=True)
+        self._thread.start()
+
+    def _fill(self, path, block_size):
+        try:
+            with gzip.open(path, 'rb') as f:
+                while not self._stop.is_set():
+                    block = f.read(block_size)
+                    self._queue.put(block)
+                    if not block:
+                        break
+        except Exception as e:
+            self._queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._block):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._block = item
+            self._pos = 0
+        n = min(len(b), len(self._block) - self._pos)
+        b[:n] = self._block[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        # unblock the producer if the caller stops reading early
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                self._thread.join(0.01)
+        super().close()
+
+'''
+    gzip input decompressed by an external multi-threaded tool (bgzip -@ or pigz -p)
+'''
+class ProcessReader(io.RawIOBase):
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._proc.stdout.readinto(b)
+        if n == 0 and self._proc.wait() != 0:
+            raise OSError(f'{self._cmd[0]} failed: {self._proc.stderr.read().decode().strip()}')
+        return n
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+        self._proc.wait()
+        super().close()
+
+# Open a compressed NGS file as a raw binary stream decompressed alongside the caller
+#   BGZF goes to bgzip and plain gzip to pigz when installed, otherwise a background thread is used
+cpdef open_compressed(str file_path, int threads=DECOMPRESS_THREADS):
+    if is_bgzf(file_path) and shutil.which('bgzip'):
+        return ProcessReader(['bgzip', '-dc', '-@', str(threads), file_path])
+    if shutil.which('pigz'):
+        return ProcessReader(['pigz', '-dc', '-p', str(threads), file_path])
+    return ThreadedGzipReader(file_path)
+
+# Open an NGS file for reading, transparently decompressing .gz input
+cpdef open_ngs(str file_path, bint text=True):
+    if is_compressed(file_path):
+        f = io.BufferedReader(open_compressed(file_path), BLOCK_SIZE)
+        return io.TextIOWrapper(f) if text else f
+    return open(file_path, 'r' if text else 'rb')
+
+# Hash the contents of the database file so a stale index is never reused
+cpdef str db_content_hash(str db_file):
+    h = hashlib.sha1()
+    with open(db_file, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+# Path of the on-disk index for a database content hash and k-mer size
+cpdef str index_path(str db_hash, int k):
+    return os.path.join(INDEX_DIR, f'{db_hash}_k{k}_v{INDEX_VERSION}.idx')
+
+# Parse the database file once and build the preprocessing and alignment automata
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef build_database(str db_file, int k, str db_hash):
+    cdef long total_length = 0
     cdef str s
+    cdef dict seqs = {}
+    cdef dict offsets = {}
+
     with open(db_file, 'r') as f:
         for record in SeqIO.parse(f, "fasta"):
             s = str(record.seq)
+            offsets[record.id] = (total_length, len(s))
+            total_length += len(s)
+            # a repeated UID keeps only its last record, like the offsets above
             if len(s) > 0:
-                records[record.id] = s
+                seqs[record.id] = s
             else:
-                continue
-    return records
+                seqs.pop(record.id, None)
 
-cpdef get_file_extension(file_path):
-    return os.path.splitext(file_path)[1]
+    # shared k-mers map to every occurrence so they count towards all of their UIDs
+    cdef dict uid_index = create_uid_index(seqs, k)
+    ac = build_automaton(uid_index, offsets, k)
+    packed = build_packed_index(seqs, offsets, total_length, k) if k <= 32 else None
+
+    return Database(db_file, k, db_hash, seqs, offsets, total_length, ac, packed)
+
+# Load the database from its prebuilt index, rebuilding the index when the database contents change
+cpdef load_database(str db_file, int k):
+    cdef str db_hash = db_content_hash(db_file)
+    cdef str path = index_path(db_hash, k)
+    if os.path.isfile(path):
+        try:
+            with open(path, 'rb') as f:
+                db = pickle.load(f)
+            if db.hash == db_hash and db.k == k:
+                db.path = db_file
+                return db
+        except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            pass
+    db = build_database(db_file, k, db_hash)
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    # write to a temp file first so concurrent runs never read a partial index
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(db, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return db
+
+# Format of an NGS file ('fastq' or 'fasta') from its extension, falling back to its first character
+cpdef str ngs_format(str fasta_file):
+    ext = get_file_extension(fasta_file).lower()
+    if ext in ('.fastq', '.fq'):
+        return 'fastq'
+    if ext in ('.fasta', '.fa'):
+        return 'fasta'
+    with open_ngs(fasta_file, False) as f:
+        first = f.read(1)
+    return 'fastq' if first == b'@' else 'fasta'
+
+# Yield blocks of whole lines from a binary stream, reading at most limit bytes (-1 reads to the end)
+def file_blocks(f, long limit=-1, long block_size=BLOCK_SIZE):
+    remaining = limit
+    carry = b''
+    while remaining != 0:
+        data = f.read(block_size if remaining < 0 else min(block_size, remaining))
+        if not data:
+            break
+        if remaining > 0:
+            remaining -= len(data)
+        data = carry + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            carry = data
+            continue
+        carry = data[cut:]
+        yield data[:cut]
+    if carry:
+        yield carry
+
+# Length of a read once its low quality 3' tail is clipped (BWA/cutadapt algorithm, Phred+33 scores)
+#   bases are removed from the end while the running sum of (cutoff - score) stays positive,
+#   cutting at the point where that sum peaked
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t quality_end(bytes seq, bytes qual, int cutoff):
+    cdef const unsigned char* q = qual
+    cdef Py_ssize_t n = len(qual)
+    cdef Py_ssize_t i, end = n
+    cdef long total = 0, best = 0
+    # a quality string that does not match its sequence is left alone
+    if n != len(seq):
+        return len(seq)
+    for i in range(n - 1, -1, -1):
+        total += cutoff - (q[i] - 33)
+        if total < 0:
+            break
+        if total > best:
+            best = total
+            end = i
+    return end
+
+# Length of a read once its 3' adapter is removed: the adapter starts at its first full occurrence,
+#   or at a partial copy of at least min_overlap bases running into the end of the read
+cdef Py_ssize_t adapter_start(bytes seq, bytes adapter, int min_overlap):
+    cdef Py_ssize_t n = len(seq)
+    cdef Py_ssize_t i = seq.find(adapter)
+    if i >= 0:
+        return i
+    i = seq.find(adapter[:min_overlap], max(n - len(adapter) + 1, 0))
+    while i >= 0:
+        if adapter.startswith(seq[i:]):
+            return i
+        i = seq.find(adapter[:min_overlap], i + 1)
+    return n
+
+# PREPROCESSING: 3' adapter trimming, quality-tail clipping and length filtering of reads as they are streamed
+#   adapter: 3' adapter sequence removed from the reads (see adapter_start), None to keep them whole
+#   quality: Phred score below which bases are clipped from the 3' end of FASTQ reads, 0 to keep them
+#   min_length/max_length: trimmed reads outside these lengths are dropped, max_length = 0 has no limit
+#   the read count of a file stays its number of records, dropped reads included
+class ReadTrimmer:
+
+    def __init__(self, adapter=None, quality=0, min_length=0, max_length=0, min_overlap=3):
+        if isinstance(adapter, str):
+            adapter = adapter.strip().upper().encode('ascii')
+        self.adapter = adapter or None
+        self.quality = quality
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_overlap = min(min_overlap, len(adapter)) if adapter else min_overlap
+
+    # copy of the trimmer that also drops reads too short to hold a single k-mer
+    def for_k(self, k):
+        return ReadTrimmer(self.adapter, self.quality, max(self.min_length, k), self.max_length, self.min_overlap)
+
+    # trimmed reads that pass the length filter, quals may be None (FASTA)
+    def trim(self, list seqs, list quals=None):
+        cdef list out = []
+        cdef bytes seq
+        cdef Py_ssize_t i, n
+        cdef int quality = self.quality if quals is not None else 0
+        cdef int min_overlap = self.min_overlap
+        cdef Py_ssize_t min_length = self.min_length, max_length = self.max_length
+        adapter = self.adapter
+        for i in range(len(seqs)):
+            seq = seqs[i]
+            n = len(seq)
+            if quality > 0:
+                n = quality_end(seq, quals[i], quality)
+                if n < len(seq):
+                    seq = seq[:n]
+            if adapter is not None:
+                n = adapter_start(seq, adapter, min_overlap)
+                if n < len(seq):
+                    seq = seq[:n]
+            if n >= min_length and (max_length <= 0 or n <= max_length):
+                out.append(seq)
+        return out
+
+# Yield (sequences, read count) for blocks of whole FASTQ lines
+#   sequences are the sequence lines of the complete 4-line records in the block joined by newlines,
+#   so headers and quality strings never reach the matching engines
+#   a trimmer preprocesses the reads of each block (the read count still counts every record)
+def fastq_records(blocks, trimmer=None):
+    cdef list carry = []
+    cdef list lines, seqs
+    cdef Py_ssize_t usable
+    for block in blocks:
+        if b'\r' in block:
+            block = block.replace(b'\r', b'')
+        lines = block.split(b'\n')
+        if not lines[-1]:
+            lines.pop()
+        if carry:
+            lines = carry + lines
+        usable = len(lines) - len(lines) % 4
+        carry = lines[usable:]
+        if usable == 0:
+            continue
+        if not lines[0].startswith(b'@') or not lines[usable - 2].startswith(b'+'):
+            raise ValueError('Malformed FASTQ file: every record must have 4 lines (@header, sequence, +, quality)')
+        seqs = lines[1:usable:4]
+        if trimmer is None:
+            yield (b'\n'.join(seqs), len(seqs))
+        else:
+            yield (b'\n'.join(trimmer.trim(seqs, lines[3:usable:4])), len(seqs))
+    # ignore trailing blank lines, a final record cut short after its sequence still counts
+    while carry and not carry[-1]:
+        carry.pop()
+    if len(carry) >= 2 and carry[0].startswith(b'@'):
+        if trimmer is None:
+            yield (carry[1], 1)
+        else:
+            yield (b'\n'.join(trimmer.trim(carry[1:2], carry[3:4] if len(carry) > 3 else [b''])), 1)
+
+# Sequences of the complete FASTA records in a block, multi-line sequences are joined
+cdef tuple fasta_block(bytes data, trimmer):
+    cdef list seqs = []
+    if b'\r' in data:
+        data = data.replace(b'\r', b'')
+    chunks = data.split(b'\n>')
+    # anything before the first header is not part of a record
+    if chunks[0].startswith(b'>'):
+        chunks[0] = chunks[0][1:]
+    else:
+        chunks = chunks[1:]
+    for chunk in chunks:
+        seqs.append(chunk.partition(b'\n')[2].replace(b'\n', b''))
+    if trimmer is None:
+        return (b'\n'.join(seqs), len(seqs))
+    return (b'\n'.join(trimmer.trim(seqs)), len(seqs))
+
+# Yield (sequences, read count) for blocks of whole FASTA lines, optionally trimmed like fastq_records
+def fasta_records(blocks, trimmer=None):
+    carry = b''
+    for block in blocks:
+        data = carry + block if carry else block
+        # the last record may continue in the next block
+        cut = data.rfind(b'\n>')
+        if cut < 0:
+            carry = data
+            continue
+        carry = data[cut + 1:]
+        yield fasta_block(data[:cut + 1], trimmer)
+    if carry:
+        yield fasta_block(carry, trimmer)
+
+# Pair blocks of bare sequence lines with a read count of zero
+def uncounted(blocks):
+    for block in blocks:
+        yield (block, 0)
+
+# Record-aware reader: yield (newline separated sequences, exact read count) from a binary NGS stream
+cpdef ngs_records(f, str fmt, long limit=-1, trimmer=None):
+    if fmt == 'fastq':
+        return fastq_records(file_blocks(f, limit), trimmer)
+    return fasta_records(file_blocks(f, limit), trimmer)
+
+# Add a buffer of coverage offsets to the coverage array with one vectorized scatter-add
+cpdef flush_hits(coverage, list hits):
+    if not hits:
+        return
+    idx = np.array(hits, dtype=np.intp)
+    # bincount is cheaper once the buffer is as large as the coverage array itself
+    if len(idx) >= len(coverage):
+        coverage += np.bincount(idx, minlength=len(coverage)).astype(coverage.dtype, copy=False)
+    else:
+        np.add.at(coverage, idx, 1)
+    del hits[:]
+
+# Add a buffer of coverage offsets, each weighted by the number of copies of its read
+cpdef flush_weighted(coverage, list hits, list weights):
+    if not hits:
+        return
+    idx = np.array(hits, dtype=np.intp)
+    w = np.concatenate(weights)
+    if len(idx) >= len(coverage):
+        coverage += np.bincount(idx, weights=w, minlength=len(coverage)).astype(coverage.dtype)
+    else:
+        np.add.at(coverage, idx, w.astype(coverage.dtype, copy=False))
+    del hits[:]
+    del weights[:]
+
+# Align blocks of newline separated sequences with the automaton
+#   a whole block is scanned in one pass, no 18-mer contains a newline so hits never span two reads
+#   returns the read count and the time spent scanning
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef tuple align_automaton(db, records, coverage):
+    cdef long read_count = 0
+    cdef double proc_time = 0.0
+    cdef list buffer = []
+    ac = db.automaton
+    for seqs, n in records:
+        read_count += n
+        start_align = perf_counter()
+        for indx, hits in ac.iter(seqs.decode('latin-1')):
+            buffer.extend(hits)
+        if len(buffer) >= HIT_BUFFER_SIZE:
+            flush_hits(coverage, buffer)
+        proc_time += perf_counter() - start_align
+    start_align = perf_counter()
+    flush_hits(coverage, buffer)
+    proc_time += perf_counter() - start_align
+    return (read_count, proc_time)
+
+# Align blocks of newline separated distinct sequences with the automaton, adding the copy count
+#   of each sequence to its hits, the read behind a hit is found from the newlines before its end
+cdef double align_automaton_weighted(db, blocks, coverage):
+    cdef double proc_time = 0.0
+    cdef list buffer = [], weights = [], ends, sizes
+    ac = db.automaton
+    for seqs, counts in blocks:
+        start_align = perf_counter()
+        ends = []
+        sizes = []
+        for indx, hits in ac.iter(seqs.decode('latin-1')):
+            ends.append(indx)
+            sizes.append(len(hits))
+            buffer.extend(hits)
+        if ends:
+            newlines = np.flatnonzero(np.frombuffer(seqs, dtype=np.uint8) == 10)
+            weights.append(np.repeat(counts[np.searchsorted(newlines, ends)], sizes))
+        if len(buffer) >= HIT_BUFFER_SIZE:
+            flush_weighted(coverage, buffer, weights)
+        proc_time += perf_counter() - start_align
+    start_align = perf_counter()
+    flush_weighted(coverage, buffer, weights)
+    proc_time += perf_counter() - start_align
+    return proc_time
+
+# Count the database positions of one packed k-mer, found through its bucket and a binary search
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void count_code(unsigned long long code, const unsigned long long[:] codes, const long long[:] starts,
+                            const long long[:] post, const long long[:] buckets, int shift,
+                            long long[:] counts, long long weight) noexcept nogil:
+    cdef Py_ssize_t lo = buckets[code >> shift]
+    cdef Py_ssize_t end = buckets[(code >> shift) + 1]
+    cdef Py_ssize_t hi = end, mid, j
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if codes[mid] < code:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < end and codes[lo] == code:
+        for j in range(starts[lo], starts[lo + 1]):
+            counts[post[j]] += weight
+
+# Scan newline separated sequences with a rolling 2-bit code and count every database hit
+#   any byte other than A, C, G or T (N, IUPAC codes, newlines) resets the window
+#   with non-empty weights, the hits of the i-th sequence are counted weights[i] times
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void scan_packed(const unsigned char[:] buf, const unsigned char[:] lut, const unsigned long long[:] codes,
+                      const long long[:] starts, const long long[:] post, const long long[:] buckets,
+                      int shift, long long[:] counts, int k, const long long[:] weights) noexcept nogil:
+    cdef Py_ssize_t i, n = buf.shape[0]
+    cdef Py_ssize_t read = 0
+    cdef bint weighted = weights.shape[0] > 0
+    cdef long long weight = weights[0] if weighted else 1
+    cdef unsigned long long code = 0
+    cdef unsigned long long mask = (<unsigned long long>1 << (2 * k)) - 1 if k < 32 else <unsigned long long>-1
+    cdef int filled = 0
+    cdef unsigned char v
+
+    for i in range(n):
+        v = lut[buf[i]]
+        if v > 3:
+            filled = 0
+            code = 0
+            if weighted and buf[i] == b'\n':
+                read += 1
+                weight = weights[read] if read < weights.shape[0] else 0
+            continue
+        code = ((code << 2) | v) & mask
+        filled += 1
+        if filled >= k:
+            count_code(code, codes, starts, post, buckets, shift, counts, weight)
+
+# Packed k-mer table of a database, only built for k <= 32
+cdef tuple packed_index(db):
+    if db.packed is None:
+        raise ValueError(f'The packed engine supports k-mers of at most 32 bases (k={db.k})')
+    return db.packed
+
+# Align blocks of newline separated sequences with the packed engine
+#   weighted blocks carry the copy count of each sequence instead of a read count
+#   returns the read count (0 for weighted blocks) and the time spent scanning
+cdef tuple align_packed(db, records, coverage, bint weighted=False):
+    cdef long read_count = 0
+    cdef double proc_time = 0.0
+    cdef const long long[:] weights = np.empty(0, dtype=np.int64)
+    codes, starts, post, buckets = packed_index(db)
+    counts = np.zeros(len(coverage), dtype=np.int64)
+    cdef long long[:] counts_view = counts
+    cdef const unsigned char[:] lut = PACK_LUT
+    cdef const unsigned char[:] buf
+    cdef const unsigned long long[:] codes_view = codes
+    cdef const long long[:] starts_view = starts
+    cdef const long long[:] post_view = post
+    cdef const long long[:] buckets_view = buckets
+    cdef int k = db.k
+    cdef int shift = 2 * k - min(PACK_BUCKET_BITS, 2 * k)
+    for seqs, n in records:
+        if weighted:
+            weights = n
+        else:
+            read_count += n
+        buf = seqs
+        start_align = perf_counter()
+        with nogil:
+            scan_packed(buf, lut, codes_view, starts_view, post_view, buckets_view, shift, counts_view, k, weights)
+        proc_time += perf_counter() - start_align
+    coverage += counts.astype(coverage.dtype, copy=False)
+    return (read_count, proc_time)
+
+# State of the record scanner, carried from one window of a mapped file to the next
+cdef struct RecordState:
+    # FASTQ: line of the current record (0 header, 1 sequence, 2 separator, 3 quality)
+    # FASTA: -1 before the first header, 0 header, 1 sequence
+    int line
+    bint line_start
+    bint malformed
+    int filled
+    unsigned long long code
+    long long reads
+
+# Parse FASTQ/FASTA records straight from a byte buffer and count the database hits of their sequences
+#   FASTQ sequences end with their line, FASTA sequences continue over line breaks until the next header
+#   carriage returns are skipped, any other byte that is not A, C, G or T resets the k-mer window
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void scan_mapped(const unsigned char[:] buf, bint fastq, RecordState* st, const unsigned char[:] lut,
+                      const unsigned long long[:] codes, const long long[:] starts, const long long[:] post,
+                      const long long[:] buckets, int shift, long long[:] counts, int k) noexcept nogil:
+    cdef Py_ssize_t i, n = buf.shape[0]
+    cdef unsigned long long mask = (<unsigned long long>1 << (2 * k)) - 1 if k < 32 else <unsigned long long>-1
+    cdef unsigned char c, v
+
+    for i in range(n):
+        c = buf[i]
+        if c == b'\n':
+            if fastq:
+                # blank lines between records are skipped
+                if not (st.line_start and st.line == 0):
+                    st.line = (st.line + 1) & 3
+                st.filled = 0
+            elif st.line == 0:
+                st.line = 1
+            st.line_start = True
+            continue
+        if c == b'\r':
+            continue
+        if st.line_start:
+            st.line_start = False
+            if fastq:
+                if (st.line == 0 and c != b'@') or (st.line == 2 and c != b'+'):
+                    st.malformed = True
+                    return
+                if st.line == 0:
+                    st.reads += 1
+            elif c == b'>':
+                st.line = 0
+                st.filled = 0
+                st.reads += 1
+        if st.line != 1:
+            continue
+        v = lut[c]
+        if v > 3:
+            st.filled = 0
+            continue
+        st.code = ((st.code << 2) | v) & mask
+        st.filled += 1
+        if st.filled >= k:
+            count_code(st.code, codes, starts, post, buckets, shift, counts, 1)
+
+# Whether an NGS file can be scanned through a memory map (a regular, uncompressed file)
+cpdef bint is_mappable(str fasta_file):
+    return os.path.isfile(fasta_file) and not is_compressed(fasta_file)
+
+# ZERO-COPY: align the records between two byte offsets of an uncompressed NGS file with the packed engine,
+#   scanning them straight from a memory map without decoding or copying any line
+#   pages are released once their window is scanned so the resident set stays flat on very large files
+#   end = -1 scans to the end of the file, returns the read count and the time spent scanning
+cdef tuple align_mapped(db, str fasta_file, long start, long end, coverage):
+    cdef RecordState st
+    cdef double proc_time = 0.0
+    cdef long pos, stop, released
+    codes, starts, post, buckets = packed_index(db)
+    counts = np.zeros(len(coverage), dtype=np.int64)
+    cdef long long[:] counts_view = counts
+    cdef const unsigned char[:] lut = PACK_LUT
+    cdef const unsigned char[:] buf
+    cdef const unsigned long long[:] codes_view = codes
+    cdef const long long[:] starts_view = starts
+    cdef const long long[:] post_view = post
+    cdef const long long[:] buckets_view = buckets
+    cdef int k = db.k
+    cdef int shift = 2 * k - min(PACK_BUCKET_BITS, 2 * k)
+    cdef bint fastq = ngs_format(fasta_file) == 'fastq'
+
+    st.line = 0 if fastq else -1
+    st.line_start = True
+    st.malformed = False
+    st.filled = 0
+    st.code = 0
+    st.reads = 0
+    with open(fasta_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if end < 0 or end > size:
+            end = size
+        if start >= end:
+            return (0, 0.0)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        pos = start
+        released = start - start % mmap.PAGESIZE
+        while pos < end and not st.malformed:
+            stop = min(pos + MMAP_WINDOW, end)
+            with memoryview(mm)[pos:stop] as window:
+                buf = window
+                start_align = perf_counter()
+                with nogil:
+                    scan_mapped(buf, fastq, &st, lut, codes_view, starts_view, post_view, buckets_view,
+                                shift, counts_view, k)
+                proc_time += perf_counter() - start_align
+                buf = None
+            # drop the scanned pages from this process, they are read back from the page cache if needed again
+            if hasattr(mm, 'madvise') and stop - stop % mmap.PAGESIZE > released:
+                mm.madvise(mmap.MADV_DONTNEED, released, stop - stop % mmap.PAGESIZE - released)
+                released = stop - stop % mmap.PAGESIZE
+            pos = stop
+    finally:
+        mm.close()
+    if st.malformed:
+        raise ValueError('Malformed FASTQ file: every record must have 4 lines (@header, sequence, +, quality)')
+    coverage += counts.astype(coverage.dtype, copy=False)
+    return (st.reads, proc_time)
+
+# Write the counts of a table of distinct reads to a temporary file as a run sorted by sequence
+cdef spill_run(table, spill_dir):
+    run = tempfile.TemporaryFile(dir=spill_dir)
+    run.writelines(seq + b'\t' + str(count).encode() + b'\n' for seq, count in sorted(table.items()))
+    run.seek(0)
+    return run
+
+# Yield the (sequence, count) pairs of a spilled run
+def run_items(run):
+    for line in run:
+        seq, _, count = line.rstrip(b'\n').rpartition(b'\t')
+        yield (seq, int(count))
+
+# Merge sorted runs, summing the counts of a sequence that was spilled more than once
+def merge_runs(runs):
+    try:
+        for seq, group in itertools.groupby(heapq.merge(*[run_items(run) for run in runs]), key=itemgetter(0)):
+            yield (seq, sum(count for _, count in group))
+    finally:
+        for run in runs:
+            run.close()
+
+# Group (sequence, count) pairs into blocks of newline separated sequences and their counts
+def unique_blocks(items):
+    for chunk in iter(lambda: list(itertools.islice(items, COLLAPSE_BLOCK)), []):
+        yield (b'\n'.join([seq for seq, _ in chunk]), np.array([count for _, count in chunk], dtype=np.int64))
+
+# COLLAPSING: count identical reads with a table of at most max_unique sequences,
+#   spilling it to disk as a sorted run whenever it fills up (runs are merged back at the end)
+#   returns the read count and the (distinct sequences, copy counts) blocks to align
+cpdef tuple collapse_reads(records, long max_unique=COLLAPSE_TABLE_SIZE, spill_dir=None):
+    cdef long read_count = 0
+    cdef list runs = []
+    table = Counter()
+    for seqs, n in records:
+        if not n:
+            continue
+        read_count += n
+        table.update(seqs.split(b'\n'))
+        if len(table) >= max_unique:
+            runs.append(spill_run(table, spill_dir))
+            table = Counter()
+    if not runs:
+        return (read_count, unique_blocks(iter(table.items())))
+    if table:
+        runs.append(spill_run(table, spill_dir))
+    return (read_count, unique_blocks(merge_runs(runs)))
+
+# Align record blocks with the chosen engine
+#   collapse first counts identical reads so each distinct sequence is scanned once
+cdef tuple align_records(db, records, str engine, coverage, bint collapse=False):
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine: {engine}. Valid engines include {", ".join(ENGINES)}')
+    if collapse:
+        read_count, blocks = collapse_reads(records)
+        if engine == 'automaton':
+            return (read_count, align_automaton_weighted(db, blocks, coverage))
+        return (read_count, align_packed(db, blocks, coverage, True)[1])
+    if engine == 'automaton':
+        return align_automaton(db, records, coverage)
+    return align_packed(db, records, coverage)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 # PREPROCESSING: Separate the sequences that definitely contain a match from those who definitely don't
-cpdef separate_seqs(str db_file, str fasta_file, str contains_match_file, int k):
-    ac = ahocorasick.Automaton()
-    cdef int read_counts = 0
-    cdef str line 
-    with open(db_file, 'r') as f:
-        for record in SeqIO.parse(f, "fasta"):
-            line = str(record.seq)
-            if len(line) > 0:
-                arr = get_kmers_arr(line, k)
-                for idx, mer in enumerate(arr):
-                    ac.add_word(mer, (idx, mer))
-            else:
-                continue                 
-    ac.make_automaton()
-    in_file = open(fasta_file, "r")
+#   a ReadTrimmer trims and filters the reads first
+cpdef separate_seqs(db, str fasta_file, str contains_match_file, trimmer=None):
+    ac = db.automaton
+    cdef long read_counts = 0
+    cdef str line
+    fmt = ngs_format(fasta_file)
+    if trimmer is not None:
+        trimmer = trimmer.for_k(db.k)
+    in_file = open_ngs(fasta_file, False)
     out_file = open(contains_match_file, "w")
-    for line in in_file:
-        read_counts += 1
-        if line.startswith('A') or line.startswith('G') or line.startswith('T') or line.startswith('C'):
+    for seqs, n in ngs_records(in_file, fmt, -1, trimmer):
+        read_counts += n
+        for line in seqs.decode('latin-1').split('\n'):
             for idx, mer in ac.iter(line):
-                out_file.write(line)
+                out_file.write(line + '\n')
                 break
     ac = None
     in_file.close()
     out_file.close()
-    ext = get_file_extension(fasta_file)
-    if ext == '.fastq':
-        return read_counts/4
-    elif ext == '.fasta':
-        return read_counts/2
-    else:
-        return 1
+    return read_counts
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 # Aligns all sequences and returns hashmap with expression levels mapped to the UIDs
-cpdef seq_aligner(str db_file, str known_match_file, int k):
+cpdef seq_aligner(db, str known_match_file, dtype=None):
+    coverage = new_coverage(db, dtype)
+    # the matches file holds one sequence per line
+    with open(known_match_file, 'rb') as in_file:
+        align_automaton(db, uncounted(file_blocks(in_file)), coverage)
+    return coverage_views(db, coverage)
 
-    cdef int i
-    cdef str key, test_string
-    
-    cdef dict uid_index = create_uid_index(db_file, k) 
-    cdef dict matches = uid_length_index(db_file) 
 
-    ac = ahocorasick.Automaton()
-    ac1 = ahocorasick.Automaton()
-    ac2 = ahocorasick.Automaton()
+# SINGLE PASS: preprocess and align each read as it is read, without writing a matches file
+#   returns the read count, the expression hashmap and the time spent in each of the two phases
+#   (reading and parsing records vs matching them)
+#   engine selects Aho-Corasick matching ('automaton') or the 2-bit packed k-mer table ('packed')
+#   gzip and BGZF input is decompressed on the fly
+#   mapped lets the packed engine scan uncompressed files through a memory map (align_mapped)
+#   collapse aligns each distinct read once and weights its hits by its number of copies (collapse_reads)
+#   a ReadTrimmer trims and filters the reads before they reach the engines, reads shorter than k are dropped
+cpdef tuple stream_align(db, str fasta_file, dtype=None, str engine='automaton', bint mapped=True,
+                         bint collapse=False, trimmer=None):
+    coverage = new_coverage(db, dtype)
+    start = perf_counter()
+    if engine == 'packed' and mapped and not collapse and trimmer is None and is_mappable(fasta_file):
+        read_count, proc_time = align_mapped(db, fasta_file, 0, -1, coverage)
+    else:
+        if trimmer is not None:
+            trimmer = trimmer.for_k(db.k)
+        with open_ngs(fasta_file, False) as in_file:
+            records = ngs_records(in_file, ngs_format(fasta_file), -1, trimmer)
+            read_count, proc_time = align_records(db, records, engine, coverage, collapse)
+    pre_time = (perf_counter() - start) - proc_time
+    return (read_count, coverage_views(db, coverage), pre_time, proc_time)
 
-    for key, ss_arr in uid_index.items():
-        for i, mer in enumerate(ss_arr):
-            if not mer in ac:
-                ac.add_word(mer, (i, key))
-            elif not mer in ac1: 
-                ac1.add_word(mer, (i, key))
-            else:
-                ac2.add_word(mer, (i, key))
-    
-    ac.make_automaton()
-    ac1.make_automaton()
-    ac2.make_automaton()
-
-    with open(known_match_file, 'r') as in_file: 
-        for test_string in in_file:
-            if len(ac) != 0:
-                for indx, (i, key) in ac.iter(test_string):
-                    matches[key][i] += 1
-            if len(ac1) != 0:
-                for indx, (i, key) in ac1.iter(test_string):
-                    matches[key][i] += 1
-            if len(ac2) != 0:
-                for indx, (i, key) in ac2.iter(test_string):
-                    matches[key][i] += 1
-    ac = None
-    ac1 = None
-    ac2 = None
-    return matches
+
+# Find the offset of the first record starting at or after the current position of a binary file
+cdef long record_start(f, str fmt):
+    cdef long line_pos
+    while True:
+        line_pos = f.tell()
+        line = f.readline()
+        if not line:
+            return line_pos
+        if fmt == 'fastq':
+            # quality lines may also start with '@' so the separator line has to follow two lines later
+            if line.startswith(b'@'):
+                f.readline()
+                if f.readline().startswith(b'+'):
+                    return line_pos
+                f.seek(line_pos + len(line))
+        elif line.startswith(b'>'):
+            return line_pos
+
+# Split an NGS file into at most n record-aligned byte ranges
+cpdef list chunk_ranges(str fasta_file, int n):
+    cdef long size = os.path.getsize(fasta_file)
+    cdef long pos
+    cdef list bounds = [0]
+    fmt = ngs_format(fasta_file)
+    with open(fasta_file, 'rb') as f:
+        for i in range(1, n):
+            pos = max(size * i // n, bounds[-1])
+            if pos >= size:
+                break
+            f.seek(pos)
+            if pos > 0:
+                f.readline()
+            bounds.append(record_start(f, fmt))
+    bounds.append(size)
+    return [(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i+1]]
+
+# context of the worker process pools: processes are forked where possible so they inherit
+#   the parent's state (database, matplotlib setup) copy-on-write instead of rebuilding it
+def fork_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+# database shared with the worker processes
+_worker_db = None
+
+def _init_worker(db):
+    global _worker_db
+    _worker_db = db
+
+# Align one byte range of an NGS file inside a worker process
+def _align_range(args):
+    fasta_file, start, end, dtype, engine, mapped, collapse, trimmer = args
+    coverage = new_coverage(_worker_db, dtype)
+    t = perf_counter()
+    if engine == 'packed' and mapped and not collapse and trimmer is None:
+        read_count, proc_time = align_mapped(_worker_db, fasta_file, start, end, coverage)
+    else:
+        if trimmer is not None:
+            trimmer = trimmer.for_k(_worker_db.k)
+        with open(fasta_file, 'rb') as f:
+            f.seek(start)
+            records = ngs_records(f, ngs_format(fasta_file), end - start, trimmer)
+            read_count, proc_time = align_records(_worker_db, records, engine, coverage, collapse)
+    return (read_count, coverage, (perf_counter() - t) - proc_time, proc_time)
+
+# PARALLEL: split the NGS file into record-aligned ranges, align each in its own process
+#   and sum the coverage vectors (identical to stream_align, which is used for a single worker)
+#   compressed input cannot be split by byte offset, so it is aligned by a single stream_align
+cpdef tuple parallel_stream_align(db, str fasta_file, int workers, dtype=None, str engine='automaton',
+                                  bint mapped=True, bint collapse=False, trimmer=None):
+    if workers <= 1 or is_compressed(fasta_file):
+        return stream_align(db, fasta_file, dtype, engine, mapped, collapse, trimmer)
+    ranges = chunk_ranges(fasta_file, workers)
+    if len(ranges) <= 1:
+        return stream_align(db, fasta_file, dtype, engine, mapped, collapse, trimmer)
+
+    start = perf_counter()
+    with fork_context().Pool(len(ranges), initializer=_init_worker, initargs=(db,)) as pool:
+        parts = pool.map(_align_range, [(fasta_file, a, b, dtype, engine, mapped, collapse, trimmer) for a, b in ranges])
+
+    coverage = new_coverage(db, dtype)
+    cdef long read_count = 0
+    cdef double pre_cpu = 0.0, proc_cpu = 0.0
+    for part_reads, part_coverage, part_pre, part_proc in parts:
+        read_count += part_reads
+        pre_cpu += part_pre
+        proc_cpu += part_proc
+        coverage += part_coverage
+
+    # report wall-clock time split in the same ratio as the workers' time in each phase
+    elapsed = perf_counter() - start
+    proc_time = elapsed * (proc_cpu / (pre_cpu + proc_cpu)) if (pre_cpu + proc_cpu) > 0 else 0.0
+    return (read_count, coverage_views(db, coverage), elapsed - proc_time, proc_time)
@@ -2,17 +2,28 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import Util
+import Procedure
+from reportlab import rl_config
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import HexColor
+from reportlab.lib.utils import ImageReader
 import numpy as np
+from io import BytesIO
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
-# create instance of report lab canvas
-def create_canvas(db_path, ngs_path, session):
-    db_exp = Util.fname_from_path(db_path)
-    ng_exp = Util.fname_from_path(ngs_path)
-    output_pdf = f'output/{session}/reports/{ng_exp}({db_exp}).pdf'
-    c = canvas.Canvas(output_pdf, pagesize=letter)
+# plots handed to a rendering process at a time
+PLOT_CHUNK = 16
+
+# streams (the plot JPGs above all) are written binary rather than ASCII85 encoded, a quarter smaller
+rl_config.useA85 = 0
+
+# create instance of report lab canvas writing a pdf to a path or to an open file (i.e. a zip member)
+#   page content streams are compressed, the document is written out when the canvas is saved
+def create_canvas(output_pdf):
+    c = canvas.Canvas(output_pdf, pagesize=letter, pageCompression=1)
     return c
 
 # set style of title page
@@ -27,13 +38,13 @@ def style_peak_page(c, page_width, page_height):
     c.setFillColor(HexColor('#FFFFFF'))
     c.rect(0,0,page_width,page_height,fill=1)
 
-# save the pdf report and delete all of the temp image files
-def cleanup(pdf_canvas, session):
+# save the pdf report
+def cleanup(pdf_canvas):
     pdf_canvas.save()
-    Util.delete_temp_jpgs(f'output/{session}/temp')
 
 # create title page
-def write_title_page(c, reads, db_path, ngs_path, time_str, page_width, page_height, session):
+#   volume ('Volume 1 of 3') is written under the prompt when the report is split into several PDFs
+def write_title_page(c, reads, db_path, ngs_path, time_str, page_width, page_height, session, volume=None):
     db_name = Util.fname_from_path(db_path)
     db_size = Util.f_size(db_path)
     ng_name = Util.fname_from_path(ngs_path)
@@ -74,6 +85,9 @@ def write_title_page(c, reads, db_path, ngs_path, time_str, page_width, page_hei
     c.setFont('Helvetica', 13)
     c.drawCentredString(half, 410, prompt) 
     c.line(50, 390, (page_width-50), 390)
+    if volume:
+        c.setFont('Helvetica-Bold', 13)
+        c.drawCentredString(half, 365, volume)
     c.showPage()
 
 # write data for a single peak of a DEV
@@ -94,13 +108,114 @@ def write_pdf_peak(c, h1, h2, h3, h4, l1, l2, l3, peak_string):
 # get width and height of pdf page
 width, height = letter
 
+# draws every alignment vector plot of a process on one figure set up once:
+#   the axes, labels and legend are kept and only the data of the expression curve and of the
+#   marker, dashed bounds and shaded region of each peak changes from one plot to the next
+class PlotRenderer:
+    def __init__(self):
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(1,1,1)
+        self.expression, = self.ax.plot([], [], label='Expression')
+        # artists of each peak drawn, one set per peak like separate plot/vlines/fill_betweenx calls
+        # make them, so the legend is placed by the same artists as before
+        self.peaks = []
+        self.add_peak('Peak Start')
+        self.ax.set_xlabel('Position on miRNA')
+        self.ax.set_ylabel('Total Reads')
+        self.ax.legend()
+
+    def add_peak(self, label=None):
+        marker, = self.ax.plot([], [], 'ko', label=label)
+        bounds = self.ax.vlines([], [], [], color='g', linestyle='dashed')
+        region = self.ax.fill_betweenx([0, 0], 0, 0, color='g', alpha=0.2)
+        self.peaks.append((marker, bounds, region))
+
+    # plot the vector of one UID with its peaks marked and return it as JPG image bytes
+    def render(self, vector, rows, read_count):
+        v = Util.regen_vector(vector, read_count, rows)
+        self.expression.set_data(np.arange(len(v)), v)
+
+        while len(self.peaks) < len(rows):
+            self.add_peak()
+        while len(self.peaks) > len(rows):
+            for artist in self.peaks.pop():
+                artist.remove()
+
+        # peak extents come from the session peak table, each region reaches the
+        # height of its peak once the peaks before it have been widened
+        z = vector.copy()
+        corners = []
+        for row, (marker, bounds, region) in zip(rows, self.peaks):
+            peak = row['peak']
+            marker.set_data([peak], [z[peak]])
+            peak_start = row['start']
+            peak_end = row['end'] + 18
+            z[peak_start:peak_end] = vector[peak]
+            top = z[peak]
+            bounds.set_segments([[(peak_start, 0), (peak_start, top)], [(peak_end, 0), (peak_end, top)]])
+            # the same outline fill_betweenx([0, top], peak_start, peak_end) draws (set_verts works on every
+            # matplotlib version, FillBetweenPolyCollection.set_data needs 3.10)
+            region.set_verts([[(peak_end, 0), (peak_start, 0), (peak_start, top), (peak_end, top),
+                               (peak_end, top), (peak_end, 0)]])
+            corners += [(peak_start, 0), (peak_end, top)]
+
+        # lines are measured by relim, the bounds and regions are added like vlines and fill_betweenx add them
+        self.ax.relim()
+        self.ax.update_datalim(corners)
+        self.ax.autoscale_view()
+
+        image = BytesIO()
+        self.fig.savefig(image, format='jpg', dpi=72)
+        return image.getvalue()
+
+# renderer of this process, created with its first plot
+_renderer = None
+
+# plot the alignment vector of one UID with its peaks marked and return it as JPG image bytes
+def plot_vector(vector, rows, read_count):
+    global _renderer
+    if _renderer is None:
+        _renderer = PlotRenderer()
+    return _renderer.render(vector, rows, read_count)
+
+# process pool rendering the plots of a report, None with one worker
+def plot_pool(workers):
+    if workers <= 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=workers, mp_context=Procedure.fork_context())
+
+# images of the plots of every UID in res (ReportLab image readers over the in-memory JPGs), in page order
+#   with a pool the plots render ahead in its processes while the pages are being written
+def render_plots(res, read_count, pool=None):
+    args = ([lst[0] for lst in res.values()], [lst[2] for lst in res.values()], repeat(read_count))
+    if pool is None:
+        images = map(plot_vector, *args)
+    else:
+        images = pool.map(plot_vector, *args, chunksize=PLOT_CHUNK)
+    return (ImageReader(BytesIO(image)) for image in images)
+
+# split the vectors of a report into volumes of at most volume_pages peak pages each, as
+# (single peak vectors, multiple peak vectors) pairs in page order - 0 keeps the whole report in one volume
+def report_volumes(single_peaks, mult_peaks, volume_pages=0):
+    if volume_pages <= 0:
+        return [(single_peaks, mult_peaks)]
+    single = list(single_peaks.items())
+    # two single peak vectors share a page, each multiple peak vector has its own
+    pages = [(single[i:i+2], []) for i in range(0, len(single), 2)]
+    pages += [([], [item]) for item in mult_peaks.items()]
+    volumes = []
+    for i in range(0, max(len(pages), 1), volume_pages):
+        chunk = pages[i:i+volume_pages]
+        volumes.append((dict(item for s, m in chunk for item in s), dict(item for s, m in chunk for item in m)))
+    return volumes
+
 # create title page and write all of the single-peak alignment vectors to pdf file - two per page 
-def plot_single_peaks(pdf_canvas, res, original_record_dict, read_count, db_path, ngs_path, time_str, session):
+def plot_single_peaks(pdf_canvas, res, original_record_dict, read_count, db_path, ngs_path, time_str, session, pool=None, volume=None):
     
     style_title_page(pdf_canvas, width, height)
-    write_title_page(pdf_canvas, read_count, db_path, ngs_path, time_str, width, height, session)
+    write_title_page(pdf_canvas, read_count, db_path, ngs_path, time_str, width, height, session, volume)
 
-    fig = plt.figure()
+    images = render_plots(res, read_count, pool)
 
     i = 1
     header = 750
@@ -111,32 +226,14 @@ def plot_single_peaks(pdf_canvas, res, original_record_dict, read_count, db_path
     h4 = h3-15 
     h5 = h4 - 20 
 
-    for uid, lst in res.items():
-        vector = lst[0]
-        temp = lst[1]
-
-        standard_deviation = np.std(vector)
-
-        ax = fig.add_subplot(1,1,1)
-        z = vector.copy()
-        v = Util.regen_vector(z, read_count)
-
-        ax.plot(v, label='Expression')
-        
-        ax.set_xlabel('Position on miRNA')
-        ax.set_ylabel('Total Reads')
+    for (uid, lst), image in zip(res.items(), images):
+        rows = lst[2]
 
-        for peak in temp:
-
-            ax.plot(peak, z[peak], 'ko', label='Peak Start')
-            rpm = round(((vector[peak] / read_count) * 1000000.0), 2)
-            peak_slice = Util.val_check(z, peak, (z[peak]-(standard_deviation*0.1)))
-            peak_start = peak_slice[0]
-            peak_end = (peak_slice[-1]) + 18
-            z[peak_start:peak_end] = vector[peak]
-
-            ax.vlines(x=[peak_start, peak_end], ymin=0, ymax=z[peak], color='g', linestyle='dashed')
-            ax.fill_betweenx([0, z[peak]], peak_start, peak_end, color='g', alpha=0.2)
+        # peak extents and RPM come from the session peak table
+        for row in rows:
+            rpm = round(float(row['rpm']), 2)
+            peak_start = row['start']
+            peak_end = row['end'] + 18
 
             id_str = Util.delimit_uid(uid, '|')
             line1 = f'Reads per Million: {(rpm)}'
@@ -150,10 +247,7 @@ def plot_single_peaks(pdf_canvas, res, original_record_dict, read_count, db_path
             
             write_pdf_peak(pdf_canvas, h1, h2, h3, h4, line1, line2, line3, peak_string)
 
-        ax.legend()
-        fig.savefig(f'output/{session}/temp/{uid}.jpg', dpi=72)
-        fig.clf()
-        pdf_canvas.drawImage(f'output/{session}/temp/{uid}.jpg', 145, im_y, width=325, height=225)
+        pdf_canvas.drawImage(image, 145, im_y, width=325, height=225)
         pdf_canvas.line(50, h5, (width-50), h5)
 
         if i % 2 == 1:
@@ -173,28 +267,17 @@ def plot_single_peaks(pdf_canvas, res, original_record_dict, read_count, db_path
             h5 = h4 - 10 
             pdf_canvas.showPage() 
         i += 1
-    pdf_canvas.showPage()
+    # an even number of vectors has already ended its last page
+    if len(res) % 2 == 1:
+        pdf_canvas.showPage()
 
 # same things as plot_single_peaks but no title page created and writing multiple
 # peaks for each uid/alignment vector combo
-def plot_mult_peaks(pdf_canvas, res, original_record_dict, read_count, session):
-    fig = plt.figure()
-
-    for uid, lst in res.items():
-        vector = lst[0]
-        temp = lst[1]
-        standard_deviation = np.std(vector)
-
-        ax = fig.add_subplot(1,1,1)
-        x = vector.copy()
-        v = Util.regen_vector(x, read_count)
+def plot_mult_peaks(pdf_canvas, res, original_record_dict, read_count, session, pool=None):
+    images = render_plots(res, read_count, pool)
 
-        ax.plot(v, label='Expression')
-        
-        ax.set_xlabel('Position on miRNA')
-        ax.set_ylabel('Total Reads')
-
-        z = vector.copy()
+    for (uid, lst), image in zip(res.items(), images):
+        rows = lst[2]
 
         i = 1
         h1 = 450
@@ -203,18 +286,10 @@ def plot_mult_peaks(pdf_canvas, res, original_record_dict, read_count, session):
         h4 = 405
         h5 = 390
 
-        for peak in temp:
-            if i == 1:
-                ax.plot(peak, z[peak], 'ko', label='Peak Start')
-            if i > 1:
-                ax.plot(peak, z[peak], 'ko')
-            rpm = round(((vector[peak] / read_count) * 1000000.0), 2)
-            peak_slice = Util.val_check(z, peak, (z[peak]-(standard_deviation*0.1)))
-            peak_start = peak_slice[0]
-            peak_end = (peak_slice[-1]) + 18
-            z[peak_start:peak_end] = vector[peak]
-            ax.vlines(x=[peak_start, peak_end], ymin=0, ymax=z[peak], color='g', linestyle='dashed')
-            ax.fill_betweenx([0, z[peak]], peak_start, peak_end, color='g', alpha=0.2)
+        for row in rows:
+            rpm = round(float(row['rpm']), 2)
+            peak_start = row['start']
+            peak_end = row['end'] + 18
 
             id_str = Util.delimit_uid(uid, '|')
             line1 = f'Reads per Million: {(rpm)}'
@@ -235,8 +310,5 @@ def plot_mult_peaks(pdf_canvas, res, original_record_dict, read_count, session):
             h3 = (h2-15)
             h4 = (h3-15)
             h5 = (h4-15)
-        ax.legend()
-        fig.savefig(f'output/{session}/temp/{uid}.jpg', dpi=72)
-        fig.clf()
-        pdf_canvas.drawImage(f'output/{session}/temp/{uid}.jpg', 113, 472, width=380, height=275)
+        pdf_canvas.drawImage(image, 113, 472, width=380, height=275)
         pdf_canvas.showPage() 
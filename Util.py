@@ -3,17 +3,34 @@ from datetime import datetime
 import os
 from scipy.signal import find_peaks
 import numpy as np
+import pickle
+import struct
 import zipfile
 from collections import OrderedDict
 
 
+# version of the columnar session results written by save_session_results
+RESULTS_VERSION = 1
+
+# columns of a results file written uncompressed
+STORED_COLUMNS = ('coverage', 'uids', 'uid_order', 'offsets', 'lengths')
+
+# session result files: columnar results, and the zipped pickles of older sessions
+RESULT_EXTENSIONS = ['.npz', '.zip']
+
+# peak table of one alignment vector: peak index, first and last index above the peak threshold, RPM
+PEAK_DTYPE = np.dtype([('peak', np.int64), ('start', np.int64), ('end', np.int64), ('rpm', np.float64)])
+
+# columns of the session peak table added to PEAK_DTYPE: the UID and whether it has more than one peak
+PEAK_TABLE_FIELDS = ('uid',) + PEAK_DTYPE.names + ('multi',)
+
 # check all values surrounding true peak index to see if they should be included in the peak
 def val_check(arr, index, threshold): 
     result = []
     right_indeces = []
     left_indeces = []
 
-    for i in range((index-1), 1):
+    for i in range((index-1), -1, -1):
         if arr[i] > threshold:
             left_indeces.append(i)
         else:
@@ -35,27 +52,83 @@ def val_check(arr, index, threshold):
     result.append(max(right_indeces))
     return result
 
+# peaks of one alignment vector at or above min_rpm, as a PEAK_DTYPE table
+def vector_peaks(val, fasta_read_count, prominence=0.85, distance=18, min_rpm=5.0, standard_deviation=None):
+    if standard_deviation is None:
+        standard_deviation = np.std(val)
+    peaks, _ = find_peaks(val, prominence=standard_deviation*prominence, distance=distance)
+    rpm = (val[peaks] / fasta_read_count) * 1000000.0
+    keep = rpm >= min_rpm
+    table = np.zeros(np.count_nonzero(keep), dtype=PEAK_DTYPE)
+    table['peak'] = peaks[keep]
+    table['rpm'] = rpm[keep]
+    for i, peak in enumerate(table['peak']):
+        table['start'][i], table['end'][i] = val_check(val, peak, (val[peak]-(standard_deviation*0.1)))
+    return table
+
+# the alignment vectors laid out back to back, with the offset of each one
+#   vectors that are views of one contiguous coverage array (Procedure.coverage_views) are used in place
+def contiguous_store(vectors):
+    lengths = np.array([len(v) for v in vectors], dtype=np.int64)
+    offsets = np.zeros(len(vectors), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    base = vectors[0].base if vectors else None
+    if isinstance(base, np.ndarray) and base.ndim == 1 and len(base) == lengths.sum() and base.strides == vectors[0].strides:
+        addr = base.__array_interface__['data'][0]
+        # numpy may point empty slices anywhere, they hold no data so only the others are checked
+        if all(len(v) == 0 or (v.base is base and v.__array_interface__['data'][0] - addr == off * base.itemsize)
+               for v, off in zip(vectors, offsets)):
+            return base, offsets, lengths
+    flat = np.concatenate(vectors) if vectors else np.zeros(0)
+    return flat, offsets, lengths
+
+'''
+    PEAK CALLING: find the peaks of every alignment vector in one batch
+        - the std and maximum of all vectors are computed at once over their contiguous store
+        - only vectors whose highest position reaches min_rpm go through find_peaks
+        - returns {uid: PEAK_DTYPE table} for the vectors with at least one peak at or above min_rpm
+        - called once per alignment, the csv (get_peaks) and the session peak table (peak_table) are built from its result
+'''
+def call_peaks(results, fasta_read_count, prominence=0.85, distance=18, min_rpm=5.0):
+    uids = list(results)
+    vectors = [results[uid] for uid in uids]
+    flat, offsets, lengths = contiguous_store(vectors)
+    table = {}
+    nonempty = np.flatnonzero(lengths)
+    if len(nonempty) and fasta_read_count:
+        starts = offsets[nonempty]
+        counts = lengths[nonempty]
+        values = flat.astype(np.float64)
+        # empty vectors in between add nothing to the segment before them
+        means = np.add.reduceat(values, starts) / counts
+        deviations = values - np.repeat(means, counts)
+        stds = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+        maxima = np.maximum.reduceat(flat, starts)
+        candidates = np.flatnonzero((maxima / fasta_read_count) * 1000000.0 >= min_rpm)
+        for i in candidates:
+            uid = uids[nonempty[i]]
+            peaks = vector_peaks(results[uid], fasta_read_count, prominence, distance, min_rpm, stds[i])
+            if len(peaks):
+                table[uid] = peaks
+    return table
+
 # get the peak data for each of the alignment vectors and write to csv file
-def get_peaks(results_dict, original_record_dict, fasta_read_counts, fasta_file_name, db_file_name, session):
+#   peaks are the call_peaks tables of the results, called here when not given
+def get_peaks(results_dict, original_record_dict, fasta_read_counts, fasta_file_name, db_file_name, session, peaks=None):
     peaks_list = []
     out_file = f"output/{session}/results/{fasta_file_name}({db_file_name}).csv"
     fname_col = f'{fasta_file_name}({db_file_name})'
-    for key, val in results_dict.items():
-        standard_deviation = np.std(val)
-        peaks, _ = find_peaks(val, prominence=standard_deviation*0.85, distance=18)
-        t = val
-        for i in peaks:
-            rpm = (val[i]/fasta_read_counts)*1000000
-            round_rpm = round(rpm, 4)
+    if peaks is None:
+        peaks = call_peaks(results_dict, fasta_read_counts, 0.85, 18)
+    for key, table in peaks.items():
+        for row in table:
+            round_rpm = round(row['rpm'], 4)
             if round_rpm > 5.0:
-                peak_slice = val_check(val, i, (val[i]-(standard_deviation*0.1)))
-                peak_start = peak_slice[0]-1
-                peak_end = peak_slice[-1] + 17
+                peak_start = max(int(row['start'])-1, 0)
+                peak_end = int(row['end']) + 17
                 peak_string = original_record_dict[key][peak_start:peak_end]
                 temp = [key, round_rpm, peak_start, peak_end, peak_string, '', fname_col]
                 peaks_list.append(temp)
-            else:
-                continue
 
     with open(out_file, 'w') as f:
         fields = ['miRNA ID', 'Reads per Million', 'Peak Start', 'Peak End', 'Peak Data', 'Total Reads in NGS File', 'File Name']
@@ -66,35 +139,46 @@ def get_peaks(results_dict, original_record_dict, fasta_read_counts, fasta_file_
             writer.writerow(i)
 
 
+'''
+    peak table of a session: one row per peak at or above 5 RPM with the columns of PEAK_TABLE_FIELDS
+        - computed once at alignment time from the call_peaks tables the csv was written from (peaks)
+          and stored with the session results so reports never call peaks again
+'''
+def peak_table(results, fasta_read_count, peaks=None):
+    if peaks is None:
+        peaks = call_peaks(results, fasta_read_count)
+    uids = list(peaks)
+    sizes = np.array([len(peaks[uid]) for uid in uids], dtype=np.int64)
+    width = max((len(uid) for uid in uids), default=1)
+    dtype = [('uid', f'U{width}')] + [(name, PEAK_DTYPE[name]) for name in PEAK_DTYPE.names] + [('multi', np.bool_)]
+    table = np.zeros(sizes.sum(), dtype=dtype)
+    if uids:
+        rows = np.concatenate([peaks[uid] for uid in uids])
+        table['uid'] = np.repeat(uids, sizes)
+        for name in PEAK_DTYPE.names:
+            table[name] = rows[name]
+        table['multi'] = np.repeat(sizes > 1, sizes)
+    return table
+
+# rows of a session peak table grouped by UID, in table order
+def peaks_by_uid(table):
+    groups = OrderedDict()
+    if len(table):
+        bounds = np.flatnonzero(table['uid'][1:] != table['uid'][:-1]) + 1
+        for rows in np.split(table, bounds):
+            groups[str(rows['uid'][0])] = rows
+    return groups
+
 # get DEV in full peak width format
-def regen_vector(val, fasta_read_count):
+#   peaks are the vector's rows of the session peak table, found again when they are not given
+def regen_vector(val, fasta_read_count, peaks=None):
     t = val.copy()
-    standard_deviation = np.std(val)
-    peaks, _ = find_peaks(val, prominence=standard_deviation*0.85, distance=20)
-    for peak in peaks:
-        if ((val[peak] / fasta_read_count) * 1000000) >= 5.0:
-            peak_slice = val_check(val, peak, (val[peak]-(standard_deviation*0.1)))
-            peak_start = peak_slice[0]
-            peak_end = (peak_slice[-1]) + 18
-            t[peak_start:peak_end] = val[peak]
-        else:
-            continue
+    if peaks is None:
+        peaks = vector_peaks(val, fasta_read_count)
+    for row in peaks:
+        t[row['start']:row['end'] + 18] = val[row['peak']]
     return t
 
-'''
-    delete all of the temp image files in the temp directory
-        - addresses an odd bug with adding a different jpg image with the 
-          same file name to pdf with ReportLab
-'''
-def delete_temp_jpgs(directory_path):
-    try:
-        files = os.listdir(directory_path)
-        for file in files:
-            file_path = os.path.join(directory_path, file)
-            os.remove(file_path)
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
 '''
     cut uid off at first instance of '|' to make fit pdf page
         - all of the id's are still unique after this operation
@@ -146,48 +230,202 @@ def f_size(path):
     s_string = convert_bytes(num_bytes)
     return s_string
 
-# return file name from file path
+# return file name from file path (a trailing .gz is dropped along with the extension)
 def fname_from_path(path):
     base = os.path.basename(path)
+    if base.lower().endswith('.gz'):
+        base = base[:-3]
     split_name = os.path.splitext(base)
     return split_name[0]
 
-# compress pdf file to zip for storage space
-def compress_pdf(output_zip, output_pdf, f_name):
-    with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        zipf.write(output_pdf, arcname=f"{f_name}.pdf")
-        os.remove(output_pdf)
+# results list of an older session stored as a zipped pickle, read without extracting it
+def read_pickle_zip(zip_path):
+    with zipfile.ZipFile(zip_path, 'r') as f:
+        return pickle.loads(f.read(f.namelist()[0]))
 
-# compress pickle file to zip for storage space
-def compress_pickle(output_z, pick_f, pick_name):
-    with zipfile.ZipFile(output_z, 'w', zipfile.ZIP_DEFLATED) as f:
-        f.write(pick_f, arcname=f'{pick_name}.pickle')
-        os.remove(pick_f)
+# write NumPy arrays as the .npy members of a zip archive (the .npz layout read by np.load)
+#   the stored columns are written uncompressed so they can be memory mapped in place
+def write_npz(path, arrays, stored=()):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, arr in arrays.items():
+            info = zipfile.ZipInfo(f'{name}.npy', date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_STORED if name in stored else zipfile.ZIP_DEFLATED
+            with zf.open(info, 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
 
-# unzip pickle
-def unzip_pickle(zip_path, out_folder):
-    with zipfile.ZipFile(zip_path, 'r') as f:
-        f.extractall(out_folder)
+# memory map an uncompressed .npy member of a zip archive, None when the member is compressed
+#   zf is the archive already opened on path, if any
+def map_npz_member(path, name, zf=None):
+    if zf is None:
+        with zipfile.ZipFile(path, 'r') as zf:
+            info = zf.getinfo(f'{name}.npy')
+    else:
+        info = zf.getinfo(f'{name}.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        # the member data follows its local file header and that header's own name and extra fields
+        f.seek(info.header_offset + 26)
+        name_len, extra_len = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if not shape or 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+'''
+    columnar session results (.npz): one NumPy array per column
+        - coverage: the alignment vectors back to back, stored uncompressed to be memory mapped
+        - uids/offsets/lengths: the UID index locating each vector in the coverage,
+          uid_order: the UIDs in sorted order for a binary search
+        - sequences: the database sequences back to back, with the same offsets as the coverage
+        - peaks: the session peak table
+        - total_reads, db_path, ngs_path, time_string, session, output_fname: the run's metadata
+'''
+def save_session_results(path, res_list):
+    results, total_reads, db_path, ngs_path, full_db_seqs, time_string, session, output_fname = res_list[:8]
+    peaks = res_list[8] if len(res_list) > 8 else peak_table(results, total_reads)
+    uids = list(results)
+    coverage, offsets, lengths = contiguous_store([results[uid] for uid in uids])
+    # empty database records have no sequence entry
+    sequences = ''.join(full_db_seqs.get(uid, '') for uid in uids).encode('ascii')
+    write_npz(path, OrderedDict([
+        ('version', np.array(RESULTS_VERSION)), ('uids', np.array(uids, dtype=str)),
+        ('uid_order', np.argsort(np.array(uids, dtype=str), kind='stable')),
+        ('offsets', offsets), ('lengths', lengths), ('coverage', coverage),
+        ('sequences', np.frombuffer(sequences, dtype=np.uint8)), ('peaks', peaks),
+        ('total_reads', np.array(total_reads)), ('db_path', np.array(db_path)), ('ngs_path', np.array(ngs_path)),
+        ('time_string', np.array(time_string)), ('session', np.array(session)),
+        ('output_fname', np.array(output_fname))]), STORED_COLUMNS)
+
+# metadata columns of a results file, in results list order after the results and read count
+METADATA_COLUMNS = ('db_path', 'ngs_path', 'time_string', 'session', 'output_fname')
+
+'''
+    open session results file
+        - opening only reads the zip directory, columns are read when first used
+        - the coverage and the UID index are memory mapped, so looking up one UID is a binary search
+          over uid_order and fetching its vector only touches its own pages
+'''
+class SessionResults:
+
+    def __init__(self, path):
+        self.path = path
+        self._data = np.load(path)
+        self.version = int(self._data['version'])
+        if self.version > RESULTS_VERSION:
+            self._data.close()
+            raise ValueError(f'{path} was written by a newer version of FragmentFinder (format {self.version})')
+        self._columns = {}
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # one column of the file, memory mapped when it was written uncompressed (STORED_COLUMNS)
+    def column(self, name):
+        if name not in self._columns:
+            arr = map_npz_member(self.path, name, self._data.zip)
+            if arr is None:
+                arr = self._data[name]
+            self._columns[name] = arr
+        return self._columns[name]
+
+    @property
+    def coverage(self):
+        return self.column('coverage')
+
+    @property
+    def uids(self):
+        return [str(uid) for uid in self.column('uids')]
+
+    @property
+    def total_reads(self):
+        return int(self.column('total_reads'))
+
+    @property
+    def metadata(self):
+        return {name: str(self.column(name)) for name in METADATA_COLUMNS}
+
+    # position of a UID in the index
+    def find_uid(self, uid):
+        uids = self.column('uids')
+        order = self.column('uid_order')
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if uids[order[mid]] < uid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(order) or uids[order[lo]] != uid:
+            raise KeyError(uid)
+        return int(order[lo])
+
+    # coverage vector of one UID
+    def get_uid_vector(self, uid):
+        i = self.find_uid(uid)
+        off = self.column('offsets')[i]
+        return self.coverage[off:off + self.column('lengths')[i]]
+
+    # results list of the session, as returned by cli.align
+    def results_list(self):
+        coverage = self.coverage
+        sequences = self.column('sequences').tobytes().decode('ascii')
+        results = {}
+        full_db_seqs = {}
+        for uid, off, x in zip(self.uids, self.column('offsets'), self.column('lengths')):
+            results[uid] = coverage[off:off+x]
+            full_db_seqs[uid] = sequences[off:off+x]
+        meta = [self.metadata[name] for name in METADATA_COLUMNS]
+        return [results, self.total_reads, meta[0], meta[1], full_db_seqs, meta[2], meta[3], meta[4], self.column('peaks')]
+
+# results list of a session (see cli.align) from its columnar results file or an older zipped pickle
+def load_session_results(path):
+    if path.lower().endswith('.zip'):
+        return read_pickle_zip(path)
+    with SessionResults(path) as session_results:
+        return session_results.results_list()
+
+# coverage vector of one UID in a session results file (older zipped pickles are loaded in full)
+def get_uid_vector(path, uid):
+    if path.lower().endswith('.zip'):
+        return read_pickle_zip(path)[0][uid]
+    with SessionResults(path) as session_results:
+        return session_results.get_uid_vector(uid)
+
+# coverage vectors of one UID across many session results files, keyed by the paths as given
+#   (samples of different sessions share their results file name, so the name alone is not unique)
+def uid_across_results(paths, uid):
+    vectors = OrderedDict()
+    for path in paths:
+        vectors[path] = get_uid_vector(path, uid)
+    return vectors
 
 # separate alignment vectors by whether they have a single or multiple peaks
-def split_by_peak_count(results, count):
+#   each entry holds the vector, its peak indices and its rows of the session peak table
+#   (computed here when the session predates the stored table)
+def split_by_peak_count(results, count, table=None):
     single_peaks = {}
     mult_peaks = {}
-    for uid, vector in results.items():
-        standard_deviation = np.std(vector)
-        peaks, _ = find_peaks(vector, prominence=standard_deviation*0.9, distance=20)
-        temp = []
-        for x in range(len(peaks)):
-            if ((vector[peaks[x]] / count) * 1000000.0) >= 5.0:
-                temp.append(peaks[x])
-            else:
-                pass
-        if len(temp) == 1:
-            single_peaks[uid] = [vector, temp]
-        elif len(temp) > 1:
-            mult_peaks[uid] = [vector, temp]
+    if table is None:
+        table = peak_table(results, count)
+    for uid, rows in peaks_by_uid(table).items():
+        entry = [results[uid], list(rows['peak']), rows]
+        if rows['multi'][0]:
+            mult_peaks[uid] = entry
         else:
-            continue
+            single_peaks[uid] = entry
     return single_peaks, mult_peaks
 
 
@@ -209,10 +447,9 @@ def config_sesh_dir(base_path):
 def is_directory(file_path):
     return os.path.isdir(file_path)
 
-# check if given NGS file is valid fasta or fastq
+# check if given NGS file is valid fasta or fastq (extensions may be compound, i.e. '.fastq.gz')
 def is_valid_file_format(file_path, ext_list):
-    _, file_extension = os.path.splitext(file_path)
-    return file_extension.lower() in [ext.lower() for ext in ext_list]
+    return any(file_path.lower().endswith(ext.lower()) for ext in ext_list)
 
 # return all files with the specific extensions in a given directory
 def get_file_list(directory_path, ext_list):
@@ -233,7 +470,7 @@ def make_file_map(directory_path):
     if not os.path.isdir(directory_path):
         print(f"The specified path '{directory_path}' is not a valid directory.")
         return
-    file_list = os.listdir(directory_path)
+    file_list = [f for f in os.listdir(directory_path) if is_valid_file_format(f, RESULT_EXTENSIONS)]
     file_map = OrderedDict()
     count = 1
     for file_name in file_list:
@@ -0,0 +1,62 @@
+'''
+    Reads/second of the single pass with and without duplicate read collapsing
+    on a synthetic small-RNA like library where a few distinct reads make up most of the file
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_collapse.py [records] [reads] [distinct]
+'''
+import os
+import sys
+import time
+import random
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset
+
+
+# FASTQ file drawing its reads from the first distinct records of another one, skewed towards the first few
+def duplicated_fastq(ngs_path, reads, distinct, seed=4):
+    out_path = ngs_path.replace('.fastq', f'_dup_{reads}_{distinct}.fastq')
+    if not os.path.isfile(out_path):
+        records = []
+        with open(ngs_path) as f:
+            for i, line in enumerate(f):
+                if i % 4 == 0:
+                    if len(records) == distinct:
+                        break
+                    records.append(line)
+                else:
+                    records[-1] += line
+        rng = random.Random(seed)
+        with open(out_path, 'w') as out:
+            for _ in range(reads):
+                out.write(records[min(int(rng.paretovariate(1.0)) - 1, distinct - 1)])
+    return out_path
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    distinct = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    db_path, ngs_path = make_dataset('output/benchmarks', records, 200000)
+    dup_path = duplicated_fastq(ngs_path, reads, distinct)
+    db = Procedure.load_database(db_path, 18)
+    print(f'{records} database records, {reads} reads drawn from {distinct} distinct reads')
+
+    for engine in Procedure.ENGINES:
+        results = {}
+        for collapse in (False, True):
+            start = time.perf_counter()
+            read_count, matches, pre_t, proc_t = Procedure.stream_align(db, dup_path, engine=engine, collapse=collapse)
+            elapsed = time.perf_counter() - start
+            results[collapse] = (read_count, matches)
+            label = f'{engine} {"collapsed" if collapse else "every read"}'
+            print(f'{label:>22}: {read_count / elapsed:12,.0f} reads/s  ({elapsed:.2f}s)')
+        assert results[False][0] == results[True][0]
+        assert all(np.array_equal(results[False][1][uid], results[True][1][uid]) for uid in results[False][1])
+    print('identical read counts and coverage')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+    Reads/second of the automaton and packed matching engines on a synthetic database and read set,
+    checking that both produce the same coverage, also on a database that repeats record IDs
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_engines.py [records] [reads]
+'''
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset, random_seq, write_fastq
+
+
+# database whose records repeat some IDs (the last record wins), one of them with an empty repeat
+def write_repeated_database(path, records=200, seed=3):
+    rng = random.Random(seed)
+    seqs = {}
+    with open(path, 'w') as f:
+        for i in range(records):
+            uid = f'syn-mir-{i % (records // 2)}|MIMAT{i % (records // 2):07d}'
+            seq = '' if i == records - 1 else random_seq(rng, rng.randint(60, 120))
+            if seq:
+                seqs[uid] = seq
+            f.write(f'>{uid}\n{seq}\n')
+    return seqs
+
+# both engines must count reads only towards the record an ID resolves to
+def check_repeated_ids(directory):
+    db_path = os.path.join(directory, 'synthetic_db_repeated.txt')
+    ngs_path = os.path.join(directory, 'synthetic_repeated.fastq')
+    write_fastq(ngs_path, write_repeated_database(db_path), 20000)
+    db = Procedure.load_database(db_path, 18)
+    coverage = {engine: Procedure.stream_align(db, ngs_path, engine=engine)[1] for engine in Procedure.ENGINES}
+    base = coverage['automaton']
+    for engine, matches in coverage.items():
+        assert matches.keys() == base.keys()
+        assert all(np.array_equal(matches[uid], base[uid]) for uid in base)
+    print(f'repeated IDs: {len(base)} UIDs, {sum(int(v.sum()) for v in base.values()):,} hits, identical coverage')
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    db_path, ngs_path = make_dataset('output/benchmarks', records, reads)
+    db = Procedure.load_database(db_path, 18)
+    print(f'{records} database records, {reads} reads')
+
+    results = {}
+    for engine in Procedure.ENGINES:
+        start = time.perf_counter()
+        read_count, matches, pre_t, proc_t = Procedure.stream_align(db, ngs_path, engine=engine)
+        elapsed = time.perf_counter() - start
+        results[engine] = (read_count, matches, elapsed)
+        print(f'{engine:>10}: {read_count / elapsed:12,.0f} reads/s  ({elapsed:.2f}s)')
+
+    base_count, base_matches, base_t = results['automaton']
+    for engine, (read_count, matches, elapsed) in results.items():
+        assert read_count == base_count
+        assert all(np.array_equal(matches[uid], base_matches[uid]) for uid in base_matches)
+        if engine != 'automaton':
+            print(f'{engine} is {base_t / elapsed:.1f}x the automaton engine, identical coverage')
+    check_repeated_ids('output/benchmarks')
+
+if __name__ == '__main__':
+    main()
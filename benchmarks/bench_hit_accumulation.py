@@ -0,0 +1,74 @@
+'''
+    Hits/second of the coverage accumulation in the aligner:
+    per-hit scalar increments (previous seq_aligner loop) vs buffered scatter-add (flush_hits)
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_hit_accumulation.py [records] [reads]
+'''
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset
+
+
+# collect the coverage offsets of every hit so both strategies accumulate the same work
+def collect_hits(db, ngs_path):
+    ac = db.automaton
+    hits = []
+    with open(ngs_path, 'r') as f:
+        for line in f:
+            if line[0] in 'ACGT':
+                for indx, offs in ac.iter(line):
+                    hits.append(offs)
+    return hits
+
+# previous approach: one NumPy scalar update per hit
+def scalar_accumulate(db, hits):
+    coverage = Procedure.new_coverage(db)
+    for offs in hits:
+        for off in offs:
+            coverage[off] += 1
+    return coverage
+
+# buffered approach: extend a flat buffer and scatter-add it in large batches
+def buffered_accumulate(db, hits):
+    coverage = Procedure.new_coverage(db)
+    buffer = []
+    for offs in hits:
+        buffer.extend(offs)
+        if len(buffer) >= Procedure.HIT_BUFFER_SIZE:
+            Procedure.flush_hits(coverage, buffer)
+    Procedure.flush_hits(coverage, buffer)
+    return coverage
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    db_path, ngs_path = make_dataset('output/benchmarks', records, reads)
+    db = Procedure.load_database(db_path, 18)
+
+    hits = collect_hits(db, ngs_path)
+    total_hits = sum(len(offs) for offs in hits)
+    print(f'{records} database records, {reads} reads, {total_hits} hits')
+
+    scalar_cov, scalar_t = timed(scalar_accumulate, db, hits)
+    buffered_cov, buffered_t = timed(buffered_accumulate, db, hits)
+    assert np.array_equal(scalar_cov, buffered_cov)
+    print(f'scalar increments:   {total_hits / scalar_t:14,.0f} hits/s')
+    print(f'buffered scatter-add:{total_hits / buffered_t:14,.0f} hits/s  ({scalar_t / buffered_t:.1f}x)')
+
+    # end to end single pass, automaton scan included
+    (reads_counted, matches, pre_t, proc_t), total_t = timed(Procedure.stream_align, db, ngs_path)
+    print(f'stream_align:        {total_hits / total_t:14,.0f} hits/s end to end ({reads_counted:,.0f} reads in {total_t:.2f}s)')
+
+if __name__ == '__main__':
+    main()
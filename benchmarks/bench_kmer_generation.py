@@ -0,0 +1,84 @@
+'''
+    Time and memory of 18-mer generation and automaton construction:
+    previous unicode array get_kmers_arr (dtype U18, one slice per position)
+    vs the zero-copy bytes view get_kmers_arr and build_automaton
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_kmer_generation.py [database file]
+    defaults to the default database, or a synthetic one when it is not present
+'''
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import ahocorasick
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset
+
+K = 18
+
+# previous implementation: fill a unicode array one string slice at a time
+def legacy_kmers_arr(individual_seq, k):
+    num_kmers = len(individual_seq) - k + 1
+    kmers = np.zeros(num_kmers, dtype=np.dtype('U' + str(k)))
+    for i in range(num_kmers):
+        kmers[i] = individual_seq[i:i+k]
+    return kmers
+
+def legacy_uid_index(seqs, k):
+    return {key: legacy_kmers_arr(s, k) for key, s in seqs.items()}
+
+# previous automaton construction: one dict update and str per k-mer occurrence
+def legacy_automaton(uid_index, offsets):
+    postings = {}
+    for key, ss_arr in uid_index.items():
+        off = offsets[key][0]
+        for i, mer in enumerate(ss_arr):
+            postings.setdefault(str(mer), []).append(off + i)
+    ac = ahocorasick.Automaton()
+    for mer, hits in postings.items():
+        ac.add_word(mer, tuple(hits))
+    ac.make_automaton()
+    return ac
+
+# run func and return its result, wall time and peak traced allocation
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def fmt_mb(num_bytes):
+    return f'{num_bytes / 1e6:8.1f} MB'
+
+def main():
+    db_path = sys.argv[1] if len(sys.argv) > 1 else '.defaultdb/FF_human_db.txt'
+    if not os.path.isfile(db_path):
+        db_path, _ = make_dataset('output/benchmarks', 40000, 1)
+        print('default database not found, using a synthetic one')
+    db = Procedure.load_database(db_path, K)
+    n_kmers = sum(max(len(s) - K + 1, 0) for s in db.seqs.values())
+    print(f'{db_path}: {len(db.seqs)} records, {n_kmers} {K}-mers')
+
+    old_index, old_t, old_peak = measure(legacy_uid_index, db.seqs, K)
+    new_index, new_t, new_peak = measure(Procedure.create_uid_index, db.seqs, K)
+    old_bytes = sum(a.nbytes for a in old_index.values())
+    print('\nk-mer generation')
+    print(f'  unicode array: {old_t:7.2f}s  peak {fmt_mb(old_peak)}  arrays {fmt_mb(old_bytes)}')
+    print(f'  bytes view:    {new_t:7.2f}s  peak {fmt_mb(new_peak)}  arrays {fmt_mb(0)} (views share the sequence buffers)')
+
+    old_ac, old_t, old_peak = measure(legacy_automaton, old_index, db.offsets)
+    new_ac, new_t, new_peak = measure(Procedure.build_automaton, new_index, db.offsets, K)
+    print('\nautomaton construction')
+    print(f'  per k-mer dict: {old_t:7.2f}s  peak {fmt_mb(old_peak)}  automaton {fmt_mb(old_ac.get_stats()["total_size"])}')
+    print(f'  sorted views:   {new_t:7.2f}s  peak {fmt_mb(new_peak)}  automaton {fmt_mb(new_ac.get_stats()["total_size"])}')
+    assert len(old_ac) == len(new_ac)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+    Seconds to merge the peak CSVs of many samples into one table:
+    row by row grouping and per-group file : RPM lists (previous Merge pipeline, without its intermediate CSVs)
+    vs sorted-interval group ids and a single pivot (Merge.merge_results)
+
+    run from the repository root:
+        python benchmarks/bench_merge.py [samples] [uids]
+'''
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Merge
+
+
+# per-sample peak CSVs in the layout cli.py writes, peaks clustered around a few positions of every UID
+def synthetic_csvs(directory, samples, uids, seed=7):
+    rng = np.random.default_rng(seed)
+    centres = rng.integers(0, 90, (uids, 3))
+    file_list = []
+    for sample in range(samples):
+        name = f'sample{sample}(synthetic_db)'
+        path = os.path.join(directory, f'{name}.csv')
+        if not os.path.isfile(path):
+            rows = rng.integers(0, uids, uids // 2)
+            start = centres[rows, rng.integers(0, 3, len(rows))] + rng.integers(-6, 7, len(rows))
+            start = np.maximum(start, 0)
+            pd.DataFrame({
+                'miRNA ID': [f'syn-mir-{i}|MIMAT{i:07d}' for i in rows],
+                'Reads per Million': np.round(rng.uniform(5, 5000, len(rows)), 4),
+                'Peak Start': start,
+                'Peak End': start + rng.integers(16, 30, len(rows)),
+                'Peak Data': '',
+                'Total Reads in NGS File': np.nan,
+                'File Name': name,
+            }).to_csv(path, index=False)
+        file_list.append(path)
+    return file_list
+
+# previous approach: iterrows over the sorted peaks, then one file : RPM list per group spread into columns
+def row_merge(file_list, hmap):
+    df = pd.concat(map(pd.read_csv, file_list), ignore_index=True)
+    df = df.dropna(subset=['miRNA ID']).sort_values(['miRNA ID', 'Peak Start'], kind='stable')
+    groups = []
+    previous_start = previous_id = None
+    group_start = 0
+    for index, row in df.iterrows():
+        if (row['miRNA ID'] != previous_id or abs(row['Peak Start'] - previous_start) > 10
+                or row['Peak End'] - group_start > 40):
+            groups.append([])
+            group_start = row['Peak Start']
+        groups[-1].append(row)
+        previous_start = row['Peak Start']
+        previous_id = row['miRNA ID']
+    files = list(df['File Name'].drop_duplicates())
+    merged = []
+    for group in groups:
+        uid = group[0]['miRNA ID']
+        start = min(row['Peak Start'] for row in group)
+        end = max(row['Peak End'] for row in group)
+        rpm = {name: 0.0 for name in files}
+        for row in group:
+            rpm[row['File Name']] = max(rpm[row['File Name']], row['Reads per Million'])
+        merged.append([uid, start, end] + [rpm[name] for name in files] + [hmap[uid][int(start):int(end)]])
+    return pd.DataFrame(merged, columns=['miRNA ID', 'Peak Start', 'Peak End'] + [f' {name}' for name in files] + ['Peak Data'])
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    uids = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    directory = 'output/benchmarks/merge'
+    os.makedirs(directory, exist_ok=True)
+    file_list = synthetic_csvs(directory, samples, uids)
+    hmap = {f'syn-mir-{i}|MIMAT{i:07d}': 'ACGU' * 40 for i in range(uids)}
+    print(f'{samples} samples, {uids} UIDs')
+
+    start = time.perf_counter()
+    old = row_merge(file_list, hmap)
+    old_t = time.perf_counter() - start
+    start = time.perf_counter()
+    new = Merge.merge_results(Merge.read_results(file_list), hmap)
+    new_t = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(old, new)
+    print(f'row by row: {old_t:8.3f}s')
+    print(f'vectorized: {new_t:8.3f}s  ({old_t / new_t:.0f}x), identical tables')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+'''
+    Reads/second and peak resident memory of the packed engine on an uncompressed FASTQ file:
+    buffered record blocks (ngs_records) vs scanning the memory mapped file (align_mapped)
+
+    each mode runs in its own process so the peak RSS of one does not hide the other
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_mmap.py [records] [reads]
+'''
+import os
+import sys
+import time
+import resource
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset
+
+
+# align once in this process and print reads/s, peak RSS above the loaded database and the coverage checksum
+def run_mode(db_path, ngs_path, mapped):
+    db = Procedure.load_database(db_path, 18)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    read_count, matches, pre_t, proc_t = Procedure.stream_align(db, ngs_path, engine='packed', mapped=mapped)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    checksum = sum(int(np.sum(v)) for v in matches.values())
+    print(read_count / elapsed, peak_rss / 1024, read_count, checksum)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--mode':
+        run_mode(sys.argv[2], sys.argv[3], sys.argv[4] == 'mapped')
+        return
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 2000000
+    db_path, ngs_path = make_dataset('output/benchmarks', records, reads)
+    # build the index once so neither mode pays for it
+    Procedure.load_database(db_path, 18)
+    print(f'{records} database records, {reads} reads ({os.path.getsize(ngs_path) / 1e6:.0f} MB)')
+
+    results = {}
+    for mode in ('buffered', 'mapped'):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', db_path, ngs_path, mode],
+                             capture_output=True, text=True, check=True).stdout.split()
+        rate, rss, read_count, checksum = float(out[0]), float(out[1]), int(out[2]), int(out[3])
+        results[mode] = (read_count, checksum)
+        print(f'{mode:>10}: {rate:12,.0f} reads/s  peak RSS +{rss:7.1f} MB')
+    assert results['buffered'] == results['mapped']
+    print('identical read counts and coverage')
+
+if __name__ == '__main__':
+    main()
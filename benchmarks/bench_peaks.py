@@ -0,0 +1,71 @@
+'''
+    Seconds to call the peaks of every alignment vector of a miRBase sized database:
+    per-UID np.std + find_peaks loop (previous get_peaks) vs the batched call_peaks engine,
+    on a coverage store where only a fraction of the UIDs are expressed
+
+    run from the repository root:
+        python benchmarks/bench_peaks.py [uids] [expressed fraction]
+'''
+import os
+import sys
+import time
+import numpy as np
+from scipy.signal import find_peaks
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Util
+
+
+# contiguous coverage store with one view per UID, a few reads scattered over most vectors
+def synthetic_results(uids, expressed, seed=5):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(60, 120, uids)
+    coverage = np.zeros(lengths.sum(), dtype=np.uint32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    results = {}
+    for i in range(uids):
+        vector = coverage[offsets[i]:offsets[i] + lengths[i]]
+        vector[rng.integers(0, lengths[i], 3)] += rng.integers(0, 3, 3).astype(np.uint32)
+        if rng.random() < expressed:
+            for _ in range(rng.integers(1, 4)):
+                peak = rng.integers(5, lengths[i] - 25)
+                vector[peak:peak + 18] += rng.integers(100, 5000, dtype=np.uint32)
+        results[f'syn-mir-{i}|MIMAT{i:07d}'] = vector
+    return results
+
+# previous approach: np.std and find_peaks for every UID, RPM checked peak by peak
+def per_uid_peaks(results, read_count):
+    table = {}
+    for uid, val in results.items():
+        standard_deviation = np.std(val)
+        peaks, _ = find_peaks(val, prominence=standard_deviation*0.85, distance=18)
+        rows = []
+        for i in peaks:
+            if ((val[i] / read_count) * 1000000.0) >= 5.0:
+                rows.append((i, Util.val_check(val, i, (val[i]-(standard_deviation*0.1)))))
+        if rows:
+            table[uid] = rows
+    return table
+
+
+def main():
+    uids = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    expressed = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    results = synthetic_results(uids, expressed)
+    read_count = 10000000
+    print(f'{uids} UIDs, {expressed:.0%} expressed')
+
+    start = time.perf_counter()
+    old = per_uid_peaks(results, read_count)
+    old_t = time.perf_counter() - start
+    start = time.perf_counter()
+    new = Util.call_peaks(results, read_count, 0.85, 18)
+    new_t = time.perf_counter() - start
+
+    assert list(old) == list(new)
+    assert all([p for p, _ in old[uid]] == list(new[uid]['peak']) for uid in old)
+    print(f'   per UID: {old_t:8.3f}s')
+    print(f'   batched: {new_t:8.3f}s  ({old_t / new_t:.1f}x), identical peaks')
+
+if __name__ == '__main__':
+    main()
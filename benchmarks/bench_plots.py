@@ -0,0 +1,69 @@
+'''
+    Milliseconds to render one report plot (JPG bytes):
+    new axes, artists and legend for every UID then clf (previous plot_vector) vs
+    one preconfigured figure whose artists only get new data (Reports.PlotRenderer)
+
+    run from the repository root:
+        python benchmarks/bench_plots.py [plots]
+'''
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Util
+import Reports
+import matplotlib.pyplot as plt
+from bench_peaks import synthetic_results
+
+
+# previous approach: the axes, every artist and the legend are rebuilt for each plot
+def rebuilt_plot(fig, vector, rows, read_count):
+    ax = fig.add_subplot(1,1,1)
+    v = Util.regen_vector(vector, read_count, rows)
+    ax.plot(v, label='Expression')
+    ax.set_xlabel('Position on miRNA')
+    ax.set_ylabel('Total Reads')
+    z = vector.copy()
+    for i, row in enumerate(rows):
+        peak = row['peak']
+        if i == 0:
+            ax.plot(peak, z[peak], 'ko', label='Peak Start')
+        else:
+            ax.plot(peak, z[peak], 'ko')
+        peak_start = row['start']
+        peak_end = row['end'] + 18
+        z[peak_start:peak_end] = vector[peak]
+        ax.vlines(x=[peak_start, peak_end], ymin=0, ymax=z[peak], color='g', linestyle='dashed')
+        ax.fill_betweenx([0, z[peak]], peak_start, peak_end, color='g', alpha=0.2)
+    ax.legend()
+    image = BytesIO()
+    fig.savefig(image, format='jpg', dpi=72)
+    fig.clf()
+    return image.getvalue()
+
+
+def main():
+    plots = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    read_count = 10000000
+    results = synthetic_results(plots * 4, 0.5)
+    single_peaks, mult_peaks = Util.split_by_peak_count(results, read_count)
+    entries = (list(single_peaks.values()) + list(mult_peaks.values()))[:plots]
+    print(f'{len(entries)} plots, {len(single_peaks)} single and {len(mult_peaks)} multiple peak vectors available')
+
+    fig = plt.figure()
+    start = time.perf_counter()
+    old = [rebuilt_plot(fig, lst[0], lst[2], read_count) for lst in entries]
+    old_t = time.perf_counter() - start
+    renderer = Reports.PlotRenderer()
+    start = time.perf_counter()
+    new = [renderer.render(lst[0], lst[2], read_count) for lst in entries]
+    new_t = time.perf_counter() - start
+
+    assert old == new
+    print(f' rebuilt: {old_t / len(entries) * 1000:8.1f} ms/plot')
+    print(f'  reused: {new_t / len(entries) * 1000:8.1f} ms/plot  ({old_t / new_t:.1f}x), identical images')
+
+if __name__ == '__main__':
+    main()
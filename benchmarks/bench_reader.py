@@ -0,0 +1,69 @@
+'''
+    MB/second and read counts of the NGS readers:
+    line loop with the first-character heuristic (previous stream loop) vs record-aware parsing (ngs_records)
+
+    the synthetic quality strings are rewritten with Phred characters that are also bases (A, C, G, T),
+    which the heuristic mistakes for sequence lines
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_reader.py [records] [reads]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset
+
+
+# copy of a FASTQ file whose quality strings only use the characters A, C, G and T
+def base_quality_copy(ngs_path):
+    out_path = ngs_path.replace('.fastq', '_acgt_qual.fastq')
+    if not os.path.isfile(out_path):
+        with open(ngs_path) as f, open(out_path, 'w') as out:
+            for i, line in enumerate(f):
+                if i % 4 == 3:
+                    line = ''.join('ACGT'[j % 4] for j in range(len(line) - 1)) + '\n'
+                out.write(line)
+    return out_path
+
+# previous approach: every line starting with a base is scanned, reads are lines / 4
+def line_heuristic(ngs_path):
+    line_count = 0
+    scanned = 0
+    with open(ngs_path, 'r') as f:
+        for line in f:
+            line_count += 1
+            if line[0] in 'ACGT':
+                scanned += 1
+    return line_count // 4, scanned
+
+# record-aware reader: only sequence lines are returned, reads are counted per record
+def record_reader(ngs_path):
+    read_count = 0
+    scanned = 0
+    with open(ngs_path, 'rb') as f:
+        for seqs, n in Procedure.ngs_records(f, Procedure.ngs_format(ngs_path)):
+            read_count += n
+            scanned += n
+    return read_count, scanned
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    db_path, ngs_path = make_dataset('output/benchmarks', records, reads)
+    qual_path = base_quality_copy(ngs_path)
+
+    for path in (ngs_path, qual_path):
+        size = os.path.getsize(path) / 1e6
+        print(os.path.basename(path), f'({size:.1f} MB, {reads} reads)')
+        for name, reader in (('heuristic', line_heuristic), ('records', record_reader)):
+            start = time.perf_counter()
+            read_count, scanned = reader(path)
+            elapsed = time.perf_counter() - start
+            print(f'{name:>10}: {size / elapsed:8.1f} MB/s  reads={read_count}  lines scanned={scanned}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+    Seconds to fetch the coverage vector of one UID across many sessions:
+    zipped results pickles (previous session data) vs indexed .npz results files (Util.SessionResults)
+
+    run from the repository root:
+        python benchmarks/bench_results.py [samples] [uids]
+'''
+import os
+import sys
+import time
+import pickle
+import zipfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Util
+
+
+# results list of one synthetic session: a contiguous coverage store with one view per UID
+def synthetic_session(uids, sample, seed=6):
+    rng = np.random.default_rng(seed + sample)
+    lengths = rng.integers(60, 120, uids)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    coverage = rng.poisson(0.5, lengths.sum()).astype(np.uint32)
+    results = {}
+    seqs = {}
+    for i in range(uids):
+        uid = f'syn-mir-{i}|MIMAT{i:07d}'
+        results[uid] = coverage[offsets[i]:offsets[i] + lengths[i]]
+        seqs[uid] = 'ACGU' * (lengths[i] // 4) + 'A' * (lengths[i] % 4)
+    name = f'sample{sample}(synthetic_db)'
+    return [results, 10000000, 'synthetic_db.txt', f'sample{sample}.fastq', seqs, '00:10', 'bench', name]
+
+# previous session data: the results list pickled into a zip file
+def write_pickle_zip(path, res_list):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f:
+        f.writestr(os.path.basename(path).replace('.zip', '.pickle'), pickle.dumps(res_list))
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    uids = int(sys.argv[2]) if len(sys.argv) > 2 else 40000
+    directory = 'output/benchmarks/results'
+    os.makedirs(directory, exist_ok=True)
+    zips, npzs = [], []
+    for sample in range(samples):
+        zip_path = os.path.join(directory, f'sample{sample}.zip')
+        npz_path = os.path.join(directory, f'sample{sample}.npz')
+        if not os.path.isfile(zip_path) or not os.path.isfile(npz_path):
+            res_list = synthetic_session(uids, sample)
+            res_list.append(Util.peak_table(res_list[0], res_list[1]))
+            write_pickle_zip(zip_path, res_list)
+            Util.save_session_results(npz_path, res_list)
+        zips.append(zip_path)
+        npzs.append(npz_path)
+    uid = f'syn-mir-{uids // 2}|MIMAT{uids // 2:07d}'
+    print(f'{samples} sessions of {uids} UIDs, fetching {uid}')
+
+    start = time.perf_counter()
+    old = [Util.read_pickle_zip(path)[0][uid] for path in zips]
+    old_t = time.perf_counter() - start
+    start = time.perf_counter()
+    new = Util.uid_across_results(npzs, uid)
+    new_t = time.perf_counter() - start
+
+    assert list(new) == npzs
+    assert all(np.array_equal(a, b) for a, b in zip(old, new.values()))
+    print(f'zipped pickles: {old_t:8.3f}s')
+    print(f' indexed .npz: {new_t:8.3f}s  ({old_t / new_t:.0f}x), identical vectors')
+
+if __name__ == '__main__':
+    main()
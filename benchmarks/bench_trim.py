@@ -0,0 +1,99 @@
+'''
+    Checks ReadTrimmer on known reads (adapters, quality tails, all-low-quality and too short reads),
+    then measures reads/second of ReadTrimmer.trim on a synthetic read set with 3' adapters
+
+    run from the repository root after building Procedure:
+        python benchmarks/bench_trim.py [reads]
+'''
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Procedure
+from synthetic import make_dataset, random_seq
+
+ADAPTER = 'TGGAATTCTCGGGTGCCAAGG'
+K = 18
+
+
+# (name, sequence, quality, trimmed length or None when the read is dropped)
+#   inserts are fixed so the expected lengths can be read off the cases
+def known_reads():
+    insert = 'ACGTTGCAAGCTTCGATCGATGCATG'
+    good = 'I'
+    low = '#'
+    return [
+        ('full adapter', insert[:22] + ADAPTER, good * 43, 22),
+        ('partial adapter', insert[:20] + ADAPTER[:5], good * 25, 20),
+        ('overlap below minimum', insert[:25] + ADAPTER[:2], good * 27, 27),
+        ('adapter only', ADAPTER + 'ACGT', good * 25, None),
+        ('quality tail', insert[:20] + 'ACGAC', good * 20 + low * 5, 20),
+        ('good base inside tail', insert[:24], good * 20 + low + '?' + low * 2, 20),
+        ('all low quality', insert[:24], low * 24, None),
+        ('shorter than k', insert[:15], good * 15, None),
+        ('adapter leaves too few bases', insert[:12] + ADAPTER, good * 33, None),
+        ('longer than maximum', insert + insert[:10], good * 36, None),
+    ]
+
+# trim the known reads one at a time and together, asserting every length and the number dropped
+def check_known_reads():
+    trimmer = Procedure.ReadTrimmer(ADAPTER, quality=20, max_length=30).for_k(K)
+    cases = known_reads()
+    for name, seq, qual, expected in cases:
+        out = trimmer.trim([seq.encode('ascii')], [qual.encode('ascii')])
+        got = len(out[0]) if out else None
+        assert got == expected, f'{name}: trimmed to {got}, expected {expected}'
+    seqs = [seq.encode('ascii') for name, seq, qual, expected in cases]
+    quals = [qual.encode('ascii') for name, seq, qual, expected in cases]
+    kept = [expected for name, seq, qual, expected in cases if expected is not None]
+    out = trimmer.trim(seqs, quals)
+    assert [len(s) for s in out] == kept
+    # FASTA reads have no qualities, so only the adapter and length filters apply
+    out = trimmer.trim(seqs)
+    assert [len(s) for s in out] == [22, 20, 27, 25, 24, 24]
+    print(f'{len(cases)} known reads: {len(kept)} kept, {len(cases) - len(kept)} dropped as expected')
+
+# dropped reads still count towards the read count of the file they were streamed from
+def check_read_count(directory):
+    db_path, _ = make_dataset(directory)
+    db = Procedure.load_database(db_path, K)
+    path = os.path.join(directory, 'known_reads.fastq')
+    cases = known_reads()
+    with open(path, 'w') as f:
+        for i, (name, seq, qual, expected) in enumerate(cases):
+            f.write(f'@read{i}\n{seq}\n+\n{qual}\n')
+    trimmer = Procedure.ReadTrimmer(ADAPTER, quality=20, max_length=30)
+    for engine in Procedure.ENGINES:
+        read_count = Procedure.stream_align(db, path, engine=engine, trimmer=trimmer)[0]
+        assert read_count == len(cases), f'{engine}: {read_count} reads counted, expected {len(cases)}'
+    print(f'streamed: {len(cases)} reads counted by every engine, dropped reads included')
+
+# reads of 18 to 30 insert bases followed by a full or partial adapter, some with low quality tails
+def synthetic_reads(reads, seed=4):
+    rng = random.Random(seed)
+    seqs = []
+    quals = []
+    for i in range(reads):
+        insert = random_seq(rng, rng.randint(18, 30))
+        seq = insert + ADAPTER[:rng.randint(0, len(ADAPTER))]
+        tail = rng.randint(0, 6)
+        seqs.append(seq.encode('ascii'))
+        quals.append(('I' * (len(seq) - tail) + '#' * tail).encode('ascii'))
+    return seqs, quals
+
+
+def main():
+    check_known_reads()
+    check_read_count('output/benchmarks')
+    reads = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    seqs, quals = synthetic_reads(reads)
+    trimmer = Procedure.ReadTrimmer(ADAPTER, quality=20).for_k(K)
+    start = time.perf_counter()
+    out = trimmer.trim(seqs, quals)
+    elapsed = time.perf_counter() - start
+    print(f'{reads} reads, {len(out)} kept: {reads / elapsed:12,.0f} reads/s  ({elapsed:.2f}s)')
+
+if __name__ == '__main__':
+    main()
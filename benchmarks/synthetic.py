@@ -0,0 +1,43 @@
+import os
+import random
+
+BASES = 'ACGT'
+
+# random nucleotide string of the given length
+def random_seq(rng, length):
+    return ''.join(rng.choice(BASES) for _ in range(length))
+
+# write a FASTA database of random miRNA-like records and return {uid: sequence}
+def write_database(path, records=2000, min_len=60, max_len=120, seed=1):
+    rng = random.Random(seed)
+    seqs = {}
+    with open(path, 'w') as f:
+        for i in range(records):
+            uid = f'syn-mir-{i}|MIMAT{i:07d}'
+            seqs[uid] = random_seq(rng, rng.randint(min_len, max_len))
+            f.write(f'>{uid}\n{seqs[uid]}\n')
+    return seqs
+
+# write a FASTQ file where hit_rate of the reads are fragments of database records
+def write_fastq(path, seqs, reads=200000, hit_rate=0.5, seed=2):
+    rng = random.Random(seed)
+    uids = list(seqs)
+    with open(path, 'w') as f:
+        for i in range(reads):
+            if rng.random() < hit_rate:
+                s = seqs[rng.choice(uids)]
+                start = rng.randint(0, len(s) - 22)
+                read = s[start:start + rng.randint(20, 30)]
+            else:
+                read = random_seq(rng, rng.randint(18, 40))
+            f.write(f'@read{i}\n{read}\n+\n{"I" * len(read)}\n')
+
+# create the synthetic database and read set in a directory, reusing existing files
+def make_dataset(directory, records=2000, reads=200000):
+    os.makedirs(directory, exist_ok=True)
+    db_path = os.path.join(directory, f'synthetic_db_{records}.txt')
+    ngs_path = os.path.join(directory, f'synthetic_{records}_{reads}.fastq')
+    if not os.path.isfile(db_path) or not os.path.isfile(ngs_path):
+        seqs = write_database(db_path, records)
+        write_fastq(ngs_path, seqs, reads)
+    return db_path, ngs_path
@@ -2,10 +2,30 @@ import Procedure
 import Util
 import os
 import time
-from Reports import create_canvas, plot_mult_peaks, plot_single_peaks, cleanup
-import pickle
+from Reports import create_canvas, plot_mult_peaks, plot_single_peaks, plot_pool, report_volumes, cleanup
 from collections import OrderedDict
 import shutil
+import zipfile
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# YAML run manifests are optional, JSON and TSV manifests work without PyYAML
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# NGS file types that can be aligned, plain or gzip/BGZF compressed
+NGS_EXTENSIONS = ['.fasta', '.fastq', '.fasta.gz', '.fastq.gz']
+
+# database file types and the database used when a session does not name one
+DB_EXTENSIONS = ['.txt', '.fasta']
+DEFAULT_DB = '.defaultdb/FF_human_db.txt'
+
+# options of the alignment and report phases with their defaults, shared by the interactive session,
+# the align/report/run commands and run manifests
+RUN_OPTIONS = OrderedDict([('workers', 1), ('jobs', 1), ('engine', 'automaton'), ('collapse', False), ('adapter', None),
+                           ('quality_cutoff', 0), ('min_length', 0), ('max_length', 0), ('volume_pages', 0)])
 
 
 # get count of mapped miRNA's
@@ -27,17 +47,20 @@ def get_db_path():
     if db_choice in {'n', 'N'}:
         while True:
             path = input('\nPlease enter the full path to the \nDatabase file you would like to use: ').strip()
-            if Util.is_valid_file_format(path, ['.txt', '.fasta']):
+            if Util.is_valid_file_format(path, DB_EXTENSIONS):
                 break
             else:
                 print(f'\nInvalid Database file: {path}\nThe Database file must either be a TXT or FASTA file.\n')
     elif db_choice in {'y', 'Y'}:
-        path = '.defaultdb/FF_human_db.txt'
+        path = DEFAULT_DB
     return path
 
 
-# generate report for one NGS/DB file pair from the results list that was stored in pickle
-def generate_selection_report(result_list):
+# generate report for one NGS/DB file pair from the results list that was stored in the session data
+#   workers > 1 renders the plots in that many processes, the pages are still written in UID order
+#   volume_pages > 0 splits the report into PDF volumes of at most that many peak pages, which bounds
+#   the memory held by the document being written (0 writes a single PDF)
+def generate_selection_report(result_list, workers=1, volume_pages=0):
     results = result_list[0]
     total_reads = result_list[1]
     db_p = result_list[2]
@@ -46,75 +69,134 @@ def generate_selection_report(result_list):
     time_string = result_list[5]
     sesh = result_list[6]
     output_fname = result_list[7]
-    single_peaks, mult_peaks = Util.split_by_peak_count(results, total_reads)
-    canv = create_canvas(db_p, ngs_p, sesh)
-    plot_single_peaks(canv, single_peaks, full_db_seqs, total_reads, db_p, ngs_p, time_string, sesh)
-    plot_mult_peaks(canv, mult_peaks, full_db_seqs, total_reads, sesh)
-    cleanup(canv, sesh)
+    # sessions saved before the peak table was stored get it computed here
+    peaks = result_list[8] if len(result_list) > 8 else None
+    single_peaks, mult_peaks = Util.split_by_peak_count(results, total_reads, peaks)
+    volumes = report_volumes(single_peaks, mult_peaks, volume_pages)
     out_z = f'output/{sesh}/reports/{output_fname}.zip'
-    out_pdf = f'output/{sesh}/reports/{output_fname}.pdf'
-    Util.compress_pdf(out_z, out_pdf, output_fname)
+    # every PDF is written straight into its member of the compressed report file
+    with zipfile.ZipFile(out_z, 'w', zipfile.ZIP_DEFLATED) as zipf, plot_pool(workers) as pool:
+        for i, (single, mult) in enumerate(volumes, 1):
+            if len(volumes) == 1:
+                pdf_name, volume = output_fname, None
+            else:
+                pdf_name, volume = f'{output_fname}_vol{i}', f'Volume {i} of {len(volumes)}'
+            with zipf.open(f'{pdf_name}.pdf', 'w', force_zip64=True) as pdf:
+                canv = create_canvas(pdf)
+                plot_single_peaks(canv, single, full_db_seqs, total_reads, db_p, ngs_p, time_string, sesh, pool, volume)
+                plot_mult_peaks(canv, mult, full_db_seqs, total_reads, sesh, pool)
+                cleanup(canv)
+
+# generate the report of one stored results file in a worker process
+def _report_job(result_path, volume_pages):
+    generate_selection_report(Util.load_session_results(result_path), volume_pages=volume_pages)
+
+# generate the reports of stored results files, in the order given
+#   jobs > 1 generates that many reports at once in separate processes (each renders its plots serially),
+#   otherwise each report renders its plots with workers processes
+def generate_reports(result_paths, workers=1, jobs=1, volume_pages=0):
+    count = len(result_paths)
+    if jobs <= 1 or count == 1:
+        for i, path in enumerate(result_paths):
+            generate_selection_report(Util.load_session_results(path), workers, volume_pages)
+            print(f'\nPDF report ({i+1}/{count}) complete')
+        return
+    done = 0
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=Procedure.fork_context()) as pool:
+        futures = {pool.submit(_report_job, path, volume_pages): path for path in result_paths}
+        for future in as_completed(futures):
+            future.result()
+            done += 1
+            print(f'\nPDF report ({done}/{count}) complete: {os.path.basename(futures[future])}')
 
 
 # run alignment algo and generate csv
-def align(db_path, ngs_path, session):
+#   single_pass streams the NGS file once instead of writing and re-reading temp/matches.txt
+#   workers > 1 splits the NGS file into chunks that are aligned in parallel
+#   engine selects the matching engine of the single pass ('automaton' or 'packed')
+#   collapse aligns each distinct read of the single pass once, weighted by its number of copies
+#   trimmer (Procedure.ReadTrimmer) trims adapters and low quality tails and filters reads by length on the fly
+def align(db, ngs_path, session, single_pass=True, workers=1, engine='automaton', collapse=False, trimmer=None):
+    db_path = db.path
     ngs_name = Util.fname_from_path(ngs_path)
     db_name = Util.fname_from_path(db_path)
 
-    # separate the sequences and get read count value
-    temp_matches = f'output/{session}/temp/matches.txt'
-    start_preprocess = time.perf_counter()
-    total_reads = Procedure.separate_seqs(db_path, ngs_path, temp_matches, 18)
-    end_preprocess = time.perf_counter()
-    pre_time = (end_preprocess - start_preprocess)
-
-    # align sequences and get resulting dictionary
-    start_process = time.perf_counter()
-    results = Procedure.seq_aligner(db_path, temp_matches, 18)
-    end_process = time.perf_counter()
-    proc_time = (end_process - start_process)
+    if single_pass:
+        # read count, results dictionary and the time spent preprocessing vs aligning
+        total_reads, results, pre_time, proc_time = Procedure.parallel_stream_align(db, ngs_path, workers, engine=engine, collapse=collapse, trimmer=trimmer)
+    else:
+        # separate the sequences and get read count value
+        temp_matches = f'output/{session}/temp/matches.txt'
+        start_preprocess = time.perf_counter()
+        total_reads = Procedure.separate_seqs(db, ngs_path, temp_matches, trimmer)
+        end_preprocess = time.perf_counter()
+        pre_time = (end_preprocess - start_preprocess)
+
+        # align sequences and get resulting dictionary
+        start_process = time.perf_counter()
+        results = Procedure.seq_aligner(db, temp_matches)
+        end_process = time.perf_counter()
+        proc_time = (end_process - start_process)
+        os.remove(temp_matches)
 
     total_time = (pre_time + proc_time) # total time it took to align files
     time_string = Util.format_time(total_time)
-    os.remove(temp_matches)
 
-    full_db_seqs = Procedure.original_strings(db_path)
+    full_db_seqs = Procedure.original_strings(db)
     
-    Util.get_peaks(results, full_db_seqs, total_reads, ngs_name, db_name, session)
+    # peaks are called once, the csv and the peak table kept with the results (read by the reports) share them
+    calls = Util.call_peaks(results, total_reads, 0.85, 18)
+    Util.get_peaks(results, full_db_seqs, total_reads, ngs_name, db_name, session, calls)
+    peaks = Util.peak_table(results, total_reads, calls)
 
     output_fname = f'{ngs_name}({db_name})'
 
     print(f'Alignment Complete! The results file has been generated in\noutput/{session}/results/{output_fname}.csv\n')
     # return tuple => time, result list:
     #   the results list contains the results dictionary, read count, db and ngs file paths
-    #   the original sequence dictionary from db file, time string, session id, and result file name
-    return (total_time, [results, total_reads, db_path, ngs_path, full_db_seqs, time_string, session, output_fname])
+    #   the original sequence dictionary from db file, time string, session id, result file name and peak table
+    return (total_time, [results, total_reads, db_path, ngs_path, full_db_seqs, time_string, session, output_fname, peaks])
+
+# store the results list as a columnar results file in the session data directory
+def save_results(res_list, sesh):
+    output_fname = res_list[7]
+    Util.save_session_results(f'output/{sesh}/data/{output_fname}.npz', res_list)
+
+# database shared with the batch worker processes
+_batch_db = None
+
+def _init_batch_worker(db):
+    global _batch_db
+    _batch_db = db
+
+# align one NGS file of a batch in a worker process and save its results
+def _batch_job(ngs_p, sesh, engine, collapse, trimmer):
+    total_time, res_list = align(_batch_db, ngs_p, sesh, engine=engine, collapse=collapse, trimmer=trimmer)
+    save_results(res_list, sesh)
+    return total_time, res_list[5], res_list[7]
 
 # for aligning and generating report when there is just one NGS file in the session
-def align_single_ngs(db_p, ngs_p, sesh):
+def align_single_ngs(db_p, ngs_p, sesh, workers=1, engine='automaton', collapse=False, trimmer=None, volume_pages=0):
 
     db_base = os.path.basename(db_p)
     ngs_base = os.path.basename(ngs_p)
 
     base_output_dir = f'output/{sesh}'
-    Util.create_dir(base_output_dir)
+    # an unattended run may be the first one in this directory, so output/ is created as well
+    os.makedirs(base_output_dir, exist_ok=True)
     Util.config_sesh_dir(base_output_dir)
 
+    db = Procedure.load_database(db_p, 18)
+
     print(f'\nAligning {db_base} and {ngs_base}...')
 
-    t, res_list = align(db_p, ngs_p, sesh)
+    t, res_list = align(db, ngs_p, sesh, workers=workers, engine=engine, collapse=collapse, trimmer=trimmer)
 
     time_string = res_list[5]
     print(f'\nTime Taken to Align (min:sec): {time_string}')
 
-    output_fname = res_list[7]
-    pickle_file = f'output/{sesh}/data/{output_fname}.pickle'
-
-    # add the results to the pickle file in case they need to be accessed later
-    with open(pickle_file, 'wb') as f:
-        pickle.dump(res_list, f)
-
-    Util.compress_pickle(f'output/{sesh}/data/{output_fname}.zip', pickle_file, output_fname)
+    # store the results in case they need to be accessed later
+    save_results(res_list, sesh)
 
     while True:
         pdf_choice = input('\nWould you like to generate a PDF \nreport of this FragmentFinder session? (y/n) ').strip()
@@ -132,45 +214,72 @@ def align_single_ngs(db_p, ngs_p, sesh):
     elif pdf_choice in {'y', 'Y'}:
         print('\nReport generation in progress.\nThe PDF will be generated as a compressed ZIP File.\nPlease note that this process may take some time.')
         print('\nPress Ctrl c to stop this process at any time.')
-        generate_selection_report(res_list)
+        generate_selection_report(res_list, workers, volume_pages)
         shutil.rmtree(f'output/{sesh}/temp')
         print(f'\nThe compressed report file has been sucessfully created in \noutput/{sesh}/reports/{res_list[7]}.zip\n\n')
 
-# for aligning multiple NGS files per session
-# each NGS and DB file pair gets their own result list (which is pickled)
-def batch_align(db_p, ngs_dir, sesh):
-
-    ngs_lst = Util.get_file_list(ngs_dir, ['.fasta', '.fastq'])
+# align a list of NGS files to a loaded database and save the results list of each one
+#   jobs > 1 aligns that many NGS files at once in separate processes
+#   returns the saved results files numbered in file order ([ngs file name, results file, output name]) and the time taken
+def align_files(db, ngs_lst, sesh, workers=1, jobs=1, engine='automaton', collapse=False, trimmer=None):
     ngs_count = len(ngs_lst)
     global_time = 0
-    pickle_files = OrderedDict()
+    result_files = OrderedDict()
+    db_base = os.path.basename(db.path)
+
+    if jobs <= 1 or ngs_count == 1:
+        for i in range(len(ngs_lst)):
+
+            ngs_p = ngs_lst[i]
+            ngs_base = os.path.basename(ngs_lst[i])
+
+            print(f'\nAligning {db_base} and {ngs_base}...')
+            total_time, res_list = align(db, ngs_p, sesh, workers=workers, engine=engine, collapse=collapse, trimmer=trimmer)
+            print(f'Alignment ({i+1}/{ngs_count}) complete.')
+
+            global_time += total_time
+
+            # save all results list to use later rather than holding in memory
+            save_results(res_list, sesh)
+            output_fname = res_list[7]
+            result_files[i+1] = [ngs_base, f'output/{sesh}/data/{output_fname}.npz', output_fname]
+
+    else:
+        # each job aligns its file serially, the workers inherit the parsed database when forked
+        print(f'\nAligning {ngs_count} NGS files to {db_base} ({jobs} at a time)...')
+        start = time.perf_counter()
+        done = 0
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=Procedure.fork_context(), initializer=_init_batch_worker, initargs=(db,)) as pool:
+            futures = {pool.submit(_batch_job, ngs_lst[i], sesh, engine, collapse, trimmer): i for i in range(ngs_count)}
+            for future in as_completed(futures):
+                i = futures[future]
+                total_time, time_string, output_fname = future.result()
+                done += 1
+                ngs_base = os.path.basename(ngs_lst[i])
+                print(f'Alignment ({done}/{ngs_count}) complete: {ngs_base} (min:sec {time_string})')
+                result_files[i+1] = [ngs_base, f'output/{sesh}/data/{output_fname}.npz', output_fname]
+        global_time = time.perf_counter() - start
+        # keep the numbering of the report menu in file order
+        result_files = OrderedDict(sorted(result_files.items()))
+
+    return result_files, global_time
+
+# for aligning multiple NGS files per session
+# each NGS and DB file pair gets their own result list (which is stored in the session data)
+#   jobs > 1 aligns that many NGS files at once in separate processes
+def batch_align(db_p, ngs_dir, sesh, workers=1, jobs=1, engine='automaton', collapse=False, trimmer=None, volume_pages=0):
+
+    ngs_lst = Util.get_file_list(ngs_dir, NGS_EXTENSIONS)
 
     base_output_dir = f'output/{sesh}'
     Util.create_dir(base_output_dir)
     Util.config_sesh_dir(base_output_dir)
 
-    for i in range(len(ngs_lst)):
+    # parse the database once for every NGS file in the session
+    db = Procedure.load_database(db_p, 18)
 
-        ngs_p = ngs_lst[i]
-        ngs_base = os.path.basename(ngs_lst[i])
-        db_base = os.path.basename(db_p)
+    result_files, global_time = align_files(db, ngs_lst, sesh, workers, jobs, engine, collapse, trimmer)
 
-        print(f'\nAligning {db_base} and {ngs_base}...')
-        total_time, res_list = align(db_p, ngs_p, sesh)
-        print(f'Alignment ({i+1}/{ngs_count}) complete.')
-
-        global_time += total_time
-    
-        output_fname = res_list[7]
-        pickle_file = f'output/{sesh}/data/{output_fname}.pickle'
-
-        # save all results list to use later rather than holding in memory
-        with open(pickle_file, 'wb') as f:
-            pickle.dump(res_list, f)
-
-        Util.compress_pickle(f'output/{sesh}/data/{output_fname}.zip', pickle_file, output_fname)
-        pickle_files[i+1] = [ngs_base, f'output/{sesh}/data/{output_fname}.zip', output_fname]
-        
     global_time_str = Util.format_time(global_time)
     print(f'\nAlignment session completed in {global_time_str}.\nAll resulting outputs have been exported to output/{sesh}/results')
 
@@ -192,47 +301,202 @@ def batch_align(db_p, ngs_dir, sesh):
     if report_choice_init in {'y', 'Y'}:
         print('\nBelow are the NGS files that were used during this session:')
 
-        for key, val in pickle_files.items():
+        for key, val in result_files.items():
             print(f'{key}.) {val[0]}')
 
         report_choice_final = input('\nEnter the numbers corresponding to the alignment\noutput you would like to generate reports for\nseparated by commas (i.e. 1,2,3,...) \nor enter 0 to generate reports for all files:\n')
         
         if report_choice_final == '0':
-            num_results = len(pickle_files)
-            i = 1
-
-            for key, val in pickle_files.items():
-                pickle_path = val[1]
-                out_f = val[2]
-                Util.unzip_pickle(pickle_path, f'output/{sesh}/data')
-                with open(f'output/{sesh}/data/{out_f}.pickle', 'rb') as file:
-                    res_lst = pickle.load(file)
-                generate_selection_report(res_lst)
-                os.remove(f'output/{sesh}/data/{out_f}.pickle')
-                print(f'\nPDF report ({i}/{num_results}) complete')
-                i += 1
-
+            result_paths = [val[1] for val in result_files.values()]
         else:
             input_list = report_choice_final.split(',')
-            input_list = [int(value) for value in input_list]
-            lst_len = len(input_list)
-            for i in range(lst_len):
-                val = pickle_files[input_list[i]]
-                pickle_path = val[1]
-                out_f = val[2]
-                Util.unzip_pickle(pickle_path, f'output/{sesh}/data')
-                with open(f'output/{sesh}/data/{out_f}.pickle', 'rb') as file:
-                    res_lst = pickle.load(file)
-                generate_selection_report(res_lst)
-                os.remove(f'output/{sesh}/data/{out_f}.pickle')
-                print(f'\nPDF report ({i+1}/{lst_len}) complete')
+            result_paths = [result_files[int(value)][1] for value in input_list]
+        generate_reports(result_paths, workers, jobs, volume_pages)
 
     print('\nAll PDF reports have been generated.\nThank you for using FragmentFinder!\n')
     shutil.rmtree(f'output/{sesh}/temp')
     return 0
         
 
-def main():
+# add the run options to a parser, left out of the parsed arguments when they are not given
+# so they can be layered over the defaults and the options of a manifest (see run_options)
+def add_run_options(parser):
+    parser.add_argument('--workers', type=int, default=argparse.SUPPRESS, help='number of processes used to align each NGS file and to render the plots of each report, unused when jobs run several files at once (default: 1)')
+    parser.add_argument('--jobs', type=int, default=argparse.SUPPRESS, help='number of NGS files aligned, and of reports generated, at once in a batch session (default: 1)')
+    parser.add_argument('--engine', choices=Procedure.ENGINES, default=argparse.SUPPRESS, help='k-mer matching engine (default: automaton)')
+    parser.add_argument('--collapse', action='store_true', default=argparse.SUPPRESS, help='align each distinct read once, weighted by its number of copies')
+    parser.add_argument('--adapter', default=argparse.SUPPRESS, help="3' adapter sequence trimmed from the reads")
+    parser.add_argument('--quality-cutoff', type=int, default=argparse.SUPPRESS, help="clip 3' read tails below this Phred quality (FASTQ only)")
+    parser.add_argument('--min-length', type=int, default=argparse.SUPPRESS, help='drop reads shorter than this after trimming (reads shorter than k=18 are always dropped)')
+    parser.add_argument('--max-length', type=int, default=argparse.SUPPRESS, help='drop reads longer than this after trimming (default: no limit)')
+    parser.add_argument('--volume-pages', type=int, default=argparse.SUPPRESS, help='split each PDF report into volumes of at most this many peak pages (default: one PDF)')
+
+# run options: the defaults, then the ones a manifest sets, then the ones given on the command line
+def run_options(args, manifest=None):
+    options = OrderedDict(RUN_OPTIONS)
+    if manifest:
+        options.update((key, value) for key, value in manifest.items() if key in RUN_OPTIONS)
+    options.update((key, value) for key, value in vars(args).items() if key in RUN_OPTIONS)
+    for key in ('workers', 'jobs'):
+        if options[key] < 1:
+            raise ValueError(f'Invalid number of {key}: {options[key]}. There must be at least 1.')
+    return options
+
+# reads are only preprocessed when one of the trimming options is given
+def make_trimmer(options):
+    if options['adapter'] or options['quality_cutoff'] or options['min_length'] or options['max_length']:
+        return Procedure.ReadTrimmer(options['adapter'], options['quality_cutoff'], options['min_length'], options['max_length'])
+    return None
+
+# value of a manifest entry as the type of its default (the values of a TSV manifest are all strings)
+def manifest_value(key, value):
+    default = RUN_OPTIONS.get(key)
+    if key == 'reports' or isinstance(default, bool):
+        if isinstance(value, str):
+            if value.strip().lower() not in {'y', 'yes', 'true', '1', 'n', 'no', 'false', '0'}:
+                raise ValueError(f"Invalid manifest value for {key}: {value}. Enter yes or no.")
+            return value.strip().lower() in {'y', 'yes', 'true', '1'}
+        return bool(value)
+    if isinstance(default, int):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid manifest value for {key}: {value}. Enter a whole number.')
+    if key == 'engine' and value not in Procedure.ENGINES:
+        raise ValueError(f"Invalid manifest value for engine: {value}. Valid engines are {', '.join(Procedure.ENGINES)}.")
+    return value if value is None else str(value)
+
+'''
+    read the run manifest of an unattended session
+        - JSON or YAML: a mapping of the keys below, samples being a list
+        - TSV: one 'key<tab>value' line per key and one 'sample<tab>path' line per sample,
+          blank lines and lines starting with '#' are skipped
+    keys:
+        session    Session ID, results go to output/<session> (required)
+        database   Database file (default: the FF_human_db database)
+        samples    NGS files or directories of NGS files (required)
+        reports    generate the PDF reports after aligning (default: yes)
+        and any run option (workers, jobs, engine, collapse, adapter, quality-cutoff, min-length, max-length, volume-pages)
+    relative paths are taken from the directory of the manifest
+'''
+def load_manifest(path):
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, 'r') as f:
+        if ext == '.json':
+            entries = json.load(f)
+        elif ext in {'.yaml', '.yml'}:
+            if yaml is None:
+                raise ValueError(f'Reading {path} needs PyYAML (pip install pyyaml). JSON and TSV manifests can be read without it.')
+            entries = yaml.safe_load(f)
+        elif ext == '.tsv':
+            entries = {'samples': []}
+            for line in f:
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                key, _, value = line.rstrip('\r\n').partition('\t')
+                if key.strip() in {'sample', 'samples'}:
+                    entries['samples'].append(value.strip())
+                else:
+                    entries[key.strip()] = value.strip()
+        else:
+            raise ValueError(f'Invalid manifest file: {path}. The manifest must be a JSON, YAML or TSV file.')
+    if not isinstance(entries, dict):
+        raise ValueError(f'Invalid manifest file: {path}. The manifest must map keys to values.')
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    manifest = {'database': DEFAULT_DB, 'reports': True}
+    for key, value in entries.items():
+        key = key.strip().replace('-', '_')
+        if key in {'sample', 'samples'}:
+            samples = [value] if isinstance(value, str) else list(value or [])
+            manifest['samples'] = [os.path.join(base_dir, str(sample)) for sample in samples]
+        elif key == 'database':
+            manifest['database'] = os.path.join(base_dir, str(value))
+        elif key == 'session':
+            manifest['session'] = str(value)
+        elif key == 'reports' or key in RUN_OPTIONS:
+            manifest[key] = manifest_value(key, value)
+        else:
+            raise ValueError(f'Invalid manifest key: {key}.')
+    if not manifest.get('session'):
+        raise ValueError(f'The manifest {path} does not give a session.')
+    if not manifest.get('samples'):
+        raise ValueError(f'The manifest {path} does not list any samples.')
+    return manifest
+
+# NGS files of a list of NGS file and directory paths, the files of each directory in name order
+def ngs_files(paths):
+    ngs_lst = []
+    for path in paths:
+        if Util.is_directory(path):
+            dir_lst = sorted(Util.get_file_list(path, NGS_EXTENSIONS))
+            if len(dir_lst) == 0:
+                raise ValueError(f'Invalid directory: {path}. The directory must contain at least one FASTA or FASTQ type file.')
+            ngs_lst += dir_lst
+        elif os.path.isfile(path) and Util.is_valid_file_format(path, NGS_EXTENSIONS):
+            ngs_lst.append(path)
+        elif not os.path.exists(path):
+            raise ValueError(f'NGS file not found: {path}.')
+        else:
+            raise ValueError(f'Invalid NGS file: {path}. NGS files must be FASTA or FASTQ type files (optionally gzip compressed).')
+
+    # a file listed more than once is aligned once, and no two samples may share the name their
+    # results are saved under (s1.fastq and s1.fastq.gz, or s1.fastq in two directories)
+    samples = OrderedDict()
+    names = {}
+    for path in ngs_lst:
+        key = os.path.realpath(path)
+        if key in samples:
+            continue
+        name = Util.fname_from_path(path)
+        if name in names:
+            raise ValueError(f'NGS files {names[name]} and {path} would both save their results as {name}. Rename one of them or align them in separate sessions.')
+        names[name] = path
+        samples[key] = path
+    return list(samples.values())
+
+# results files of a previous session, picked by NGS file name (as the report menu lists them) or by
+# result name (i.e. 's1(FF_human_db)'), all of them when no samples are given
+def session_results(sesh, samples):
+    if not Util.is_directory(f'output/{sesh}/data'):
+        raise ValueError(f'Invalid Session ID: {sesh}.')
+    df_map = Util.make_file_map(f'output/{sesh}/data')
+    if not samples:
+        return [val[1] for val in df_map.values()]
+    by_name = {}
+    for val in df_map.values():
+        by_name[val[0]] = val[1]
+        by_name[val[2]] = val[1]
+    missing = [sample for sample in samples if sample not in by_name]
+    if missing:
+        raise ValueError(f"No results for {', '.join(missing)} in session {sesh}.")
+    return [by_name[sample] for sample in samples]
+
+# align the NGS files of a session and generate their reports without any prompts,
+# in the same output/<session> layout as an interactive session
+#   reports=False only aligns, the reports can be generated later from the session data
+def run_session(sesh, db_p, ngs_lst, options, reports=True):
+    base_output_dir = f'output/{sesh}'
+    # an unattended run may be the first one in this directory, so output/ is created as well
+    os.makedirs(base_output_dir, exist_ok=True)
+    Util.config_sesh_dir(base_output_dir)
+
+    db = Procedure.load_database(db_p, 18)
+    result_files, global_time = align_files(db, ngs_lst, sesh, options['workers'], options['jobs'], options['engine'],
+                                            options['collapse'], make_trimmer(options))
+    shutil.rmtree(f'{base_output_dir}/temp')
+    global_time_str = Util.format_time(global_time)
+    print(f'\nAlignment session completed in {global_time_str}.\nAll resulting outputs have been exported to output/{sesh}/results')
+
+    if reports:
+        generate_reports([val[1] for val in result_files.values()], options['workers'], options['jobs'], options['volume_pages'])
+        print(f'\nAll PDF reports have been generated.\nThey are available in output/{sesh}/reports')
+
+
+# prompt for a new session or for reports of a previous one
+def interactive_session(options):
+
+    trimmer = make_trimmer(options)
 
     print('\nFragmentFinder Command Line Interface\n')
 
@@ -251,15 +515,15 @@ def main():
 
         while True:
             choice = input('\nTo align one NGS file, enter a single file path.\nTo align multiple NGS files, enter the path to a \ndirectory containing all of the NGS files.\n\n')
-            if not Util.is_directory(choice) and Util.is_valid_file_format(choice, ['.fasta', 'fastq']):
+            if not Util.is_directory(choice) and Util.is_valid_file_format(choice, NGS_EXTENSIONS):
                 ngs_path = choice
-                align_single_ngs(db_path, ngs_path, session_num)
+                align_single_ngs(db_path, ngs_path, session_num, options['workers'], options['engine'], options['collapse'], trimmer, options['volume_pages'])
                 return 0
-            elif not Util.is_directory(choice) and not Util.is_valid_file_format(choice, ['.fasta', '.fastq']):
-                print(f'\nInvalid NGS file: {choice}.\nPlease select a valid FASTA or FASTQ type file.\n')
+            elif not Util.is_directory(choice) and not Util.is_valid_file_format(choice, NGS_EXTENSIONS):
+                print(f'\nInvalid NGS file: {choice}.\nPlease select a valid FASTA or FASTQ type file (optionally gzip compressed).\n')
                 continue
             if Util.is_directory(choice):
-                ngs_lst = Util.get_file_list(choice, ['.fasta', '.fastq'])
+                ngs_lst = Util.get_file_list(choice, NGS_EXTENSIONS)
                 if len(ngs_lst) != 0:
                     print('\nThe following NGS files will be aligned to the Database file:\n')
                     for i in range(len(ngs_lst)):
@@ -267,7 +531,7 @@ def main():
                         print(f'{i+1}.) {f}')
                     cont = input('\nWould you like to continue (y/n): ')
                     if cont in {'y', 'Y'}:
-                        batch_align(db_path, choice, session_num)
+                        batch_align(db_path, choice, session_num, options['workers'], options['jobs'], options['engine'], options['collapse'], trimmer, options['volume_pages'])
                         return 0
                     else:
                         print("\nSelection: 'n'... Starting Over\n")
@@ -290,46 +554,76 @@ def main():
                     print(f'{key}.) {val[0]}')
 
                 report_path = f'output/{sesh_id}/reports'
-                os.makedirs(report_path)
-                os.mkdir(f'output/{sesh_id}/temp')
+                os.makedirs(report_path, exist_ok=True)
 
                 report_selection = input('\nEnter the numbers corresponding to the alignment\noutput you would like to generate reports \nfor separated by commas (i.e. 1,2,3,...) \nor enter 0 to generate reports for all files:\n')
                 print()
                 if report_selection == '0':
-                    num_results = len(df_map)
-                    i = 1
-                    for key, val in df_map.items():
-                        pickle_path = val[1]
-                        out_f = val[2]
-                        Util.unzip_pickle(pickle_path, f'output/{sesh_id}/data')
-                        with open(f'output/{sesh_id}/data/{out_f}.pickle', 'rb') as file:
-                            res_lst = pickle.load(file)
-                        generate_selection_report(res_lst)
-                        os.remove(f'output/{sesh_id}/data/{out_f}.pickle')
-                        print(f'PDF report ({i}/{num_results}) complete\n')
-                        i += 1
-
+                    result_paths = [val[1] for val in df_map.values()]
                 else:
                     input_list = report_selection.split(',')
-                    input_list = [int(value) for value in input_list]
-                    lst_len = len(input_list)
-                    for i in range(lst_len):
-                        val = df_map[input_list[i]]
-                        pickle_path = val[1]
-                        out_f = val[2]
-                        Util.unzip_pickle(pickle_path, f'output/{sesh_id}/data')
-                        with open(f'output/{sesh_id}/data/{out_f}.pickle', 'rb') as file:
-                            res_lst = pickle.load(file)
-                        generate_selection_report(res_lst)
-                        os.remove(f'output/{sesh_id}/data/{out_f}.pickle')
-                        print(f'PDF report ({i+1}/{lst_len}) complete\n')
-
-                shutil.rmtree(f'output/{sesh_id}/temp')
+                    result_paths = [df_map[int(value)][1] for value in input_list]
+                generate_reports(result_paths, options['workers'], options['jobs'], options['volume_pages'])
+
                 print(f"\nAll PDF reports have been successfully generated.\nThey are available in {report_path}")
                 return 0
-                    
 
 
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='FragmentFinder Command Line Interface',
+                                     epilog='Without a command an interactive session is started.')
+    add_run_options(parser)
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    align_parser = commands.add_parser('align', help='align NGS files to a database and save the results to a session')
+    align_parser.add_argument('ngs', nargs='+', help='NGS files or directories of NGS files')
+    align_parser.add_argument('--session', required=True, help='Session ID, results are saved to output/<session>')
+    align_parser.add_argument('--db', default=DEFAULT_DB, help=f'Database file (default: {DEFAULT_DB})')
+    align_parser.add_argument('--reports', action='store_true', help='generate the PDF reports after aligning')
+    add_run_options(align_parser)
+
+    report_parser = commands.add_parser('report', help='generate the PDF reports of a previous session')
+    report_parser.add_argument('samples', nargs='*', help='NGS file or result names to report (default: every result of the session)')
+    report_parser.add_argument('--session', required=True, help='Session ID of the results')
+    add_run_options(report_parser)
+
+    run_parser = commands.add_parser('run', help='align and report the samples listed in a run manifest (JSON, YAML or TSV)')
+    run_parser.add_argument('manifest', help='run manifest file, options given here override the manifest')
+    add_run_options(run_parser)
+
+    args = parser.parse_args(argv)
+
+    # inputs are checked before anything runs and reported like invalid arguments
+    manifest = None
+    try:
+        if args.command == 'report':
+            result_paths = session_results(args.session, args.samples)
+        elif args.command is not None:
+            if args.command == 'run':
+                manifest = load_manifest(args.manifest)
+            else:
+                manifest = {'session': args.session, 'database': args.db, 'samples': args.ngs, 'reports': args.reports}
+            ngs_lst = ngs_files(manifest['samples'])
+            if not os.path.exists(manifest['database']):
+                raise ValueError(f"Database file not found: {manifest['database']}.")
+            if not os.path.isfile(manifest['database']) or not Util.is_valid_file_format(manifest['database'], DB_EXTENSIONS):
+                raise ValueError(f"Invalid Database file: {manifest['database']}. The Database file must either be a TXT or FASTA file.")
+        # manifest options are checked here as well as the ones given on the command line
+        options = run_options(args, manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.command is None:
+        return interactive_session(options)
+    if args.command == 'report':
+        os.makedirs(f'output/{args.session}/reports', exist_ok=True)
+        generate_reports(result_paths, options['workers'], options['jobs'], options['volume_pages'])
+        print(f'\nAll PDF reports have been generated.\nThey are available in output/{args.session}/reports')
+    else:
+        run_session(manifest['session'], manifest['database'], ngs_lst, options, manifest['reports'])
+    return 0
+
 if __name__ == "__main__":
     main()
     